@@ -82,10 +82,45 @@ CREATE TABLE _rrs_library_taxon_count
   , PRIMARY KEY (rrs_library_id, taxon_level, taxon_id)
   );
 CREATE INDEX idx_rrs_library_taxon_count__taxon_id ON _rrs_library_taxon_count(taxon_id);
-CREATE INDEX idx_rrs_library_taxon_count__taxon_level ON _rrs_library_taxon_count(taxon_level);
 CREATE INDEX idx_rrs_library_taxon_count__tally ON _rrs_library_taxon_count(tally);
+-- Used by the views below to look up a level's counts by taxon:
+--   SEARCH r USING INDEX
+--     idx_rrs_library_taxon_count__taxon_level__taxon_id__tally
+--     (taxon_level=? AND taxon_id=?)
+-- Lookups by library use the primary key.
+CREATE INDEX idx_rrs_library_taxon_count__taxon_level__taxon_id__tally
+  ON _rrs_library_taxon_count(taxon_level, taxon_id, tally);
 
 
+-- Filled in one pass over _rrs_library_taxon_count by
+-- scripts/tally_rrs_totals.py, which import_db.py runs whenever the tables it
+-- reads are (re-)imported; see the views of the same names (without the
+-- leading underscore).
+CREATE TABLE _rrs_library_endemic_total
+  ( rrs_library_id  TEXT REFERENCES rrs_library(rrs_library_id)
+  , taxon_level     TEXT
+  , total           INTEGER
+
+  , PRIMARY KEY (rrs_library_id, taxon_level)
+  );
+
+CREATE TABLE _rrs_library_spike_total
+  ( rrs_library_id  TEXT REFERENCES rrs_library(rrs_library_id)
+  , taxon_level     TEXT
+  , spike_seq_id    TEXT
+  , total           INTEGER
+
+  , PRIMARY KEY (rrs_library_id, taxon_level, spike_seq_id)
+  );
+
+CREATE TABLE _rrs_library_taxon_incidence
+  ( taxon_level     TEXT
+  , taxon_id        TEXT
+  , incidence       INTEGER
+
+  , PRIMARY KEY (taxon_level, taxon_id)
+  );
+
 CREATE TABLE taxonomy
   ( taxon_id        TEXT  -- Focal sequence/OTU/taxon name
   , taxon_level     TEXT  -- The level of the focal taxon
@@ -97,7 +132,9 @@ CREATE TABLE taxonomy
   , PRIMARY KEY (taxon_id, taxon_level, taxon_id_b, taxon_level_b)
   );
   CREATE INDEX idx_taxonomy__taxon_id_b ON taxonomy(taxon_id_b);
-  CREATE INDEX idx_taxonomy__taxon_level ON taxonomy(taxon_level);
+  -- Covers lookups of a level's assignments at given parent levels.
+  CREATE INDEX idx_taxonomy__taxon_level
+    ON taxonomy(taxon_level, taxon_level_b, taxon_id, taxon_id_b, confidence);
   CREATE INDEX idx_taxonomy__taxon_level_b ON taxonomy(taxon_level_b);
 
 CREATE TABLE rrs_spike_strain_hit
@@ -105,7 +142,10 @@ CREATE TABLE rrs_spike_strain_hit
   , taxon_level   TEXT
   , spike_seq_id  TEXT
 
+  , PRIMARY KEY (taxon_id, taxon_level, spike_seq_id)
   );
+CREATE INDEX idx_rrs_spike_strain_hit__spike_seq_id
+  ON rrs_spike_strain_hit(spike_seq_id, taxon_level, taxon_id);
 
 -- Views {{{1
 -- hplc {{{2
@@ -205,9 +245,11 @@ CREATE VIEW cage_concentration AS
 
 -- rrs {{{2
 
--- Per sample list of taxa that originated in the spike.
+-- Per sample list of taxa that originated in the spike.  Rows are already
+-- unique (every table joined has a primary key on the join), so this needs
+-- no DISTINCT and its temporary B-tree.
 CREATE VIEW rrs_library_spike_taxon AS
-  SELECT DISTINCT rrs_library_id, taxon_level, taxon_id, spike_seq_id
+  SELECT rrs_library_id, taxon_level, taxon_id, spike_seq_id
   FROM rrs_library
   JOIN extraction USING (extraction_id)
   JOIN spike USING (spike_id)
@@ -216,10 +258,8 @@ CREATE VIEW rrs_library_spike_taxon AS
 
 -- Number of libraries with sequences from each taxon
 CREATE VIEW rrs_library_taxon_incidence AS
-  SELECT taxon_level, taxon_id, COUNT(*) AS incidence
-  FROM _rrs_library_taxon_count
-  WHERE tally > 0
-  GROUP BY taxon_level, taxon_id
+  SELECT taxon_level, taxon_id, incidence
+  FROM _rrs_library_taxon_incidence
 ;
 
 -- Filtered count table with singleton taxa and spike taxa removed.
@@ -227,7 +267,7 @@ CREATE VIEW rrs_library_taxon_count AS
   SELECT r.*
   FROM _rrs_library_taxon_count AS r
   LEFT JOIN rrs_library_spike_taxon AS s USING (rrs_library_id, taxon_level, taxon_id)
-  LEFT JOIN rrs_library_taxon_incidence USING (taxon_level, taxon_id)
+  LEFT JOIN _rrs_library_taxon_incidence USING (taxon_level, taxon_id)
   WHERE incidence > 1
     AND s.spike_seq_id IS NULL
 ;
@@ -237,11 +277,8 @@ CREATE VIEW rrs_library_endemic_total AS
   SELECT
       rrs_library_id
     , taxon_level
-    , SUM(tally) AS total
-  FROM _rrs_library_taxon_count
-  LEFT JOIN rrs_library_spike_taxon USING (rrs_library_id, taxon_id, taxon_level)
-  GROUP BY rrs_library_id, taxon_level, spike_seq_id
-  HAVING spike_seq_id IS NULL
+    , total
+  FROM _rrs_library_endemic_total
 ;
 
 -- Sum of all reads from each spike.
@@ -250,11 +287,8 @@ CREATE VIEW rrs_library_spike_total AS
       rrs_library_id
     , taxon_level
     , spike_seq_id
-    , SUM(tally) AS total
-  FROM _rrs_library_taxon_count
-  LEFT JOIN rrs_library_spike_taxon USING (rrs_library_id, taxon_id, taxon_level)
-  GROUP BY rrs_library_id, taxon_level, spike_seq_id
-  HAVING spike_seq_id NOT NULL
+    , total
+  FROM _rrs_library_spike_total
 ;
 
 -- Relative abundance of all endemic taxa.
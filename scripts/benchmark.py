@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""Time the data pipeline scripts on synthetic inputs at several scales.
+
+For each scale (relative to the data in this repository; see
+lib/synthetic.py), synthetic inputs are generated under WORK_DIR and each
+step of the pipeline is run in turn as a separate process.  Wall time, CPU
+time and peak memory (max RSS) of every step are appended to RESULTS, along
+with the commit being benchmarked, so regressions and scaling curves can be
+compared across commits.  Steps that fail are recorded, and the steps that
+depend on them are skipped.
+
+With --report, RESULTS is summarized instead: the median of a metric for
+each step and scale (rows) and commit (columns).
+
+usage:
+
+    benchmark.py [--scale 1 10 100] [--step STEP ...] [--work-dir DIR] \\
+        [--results RESULTS]
+    benchmark.py --report [--metric wall_seconds] [--results RESULTS]
+
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+# Peak memory of each step is measured with wait4, which (on Linux) counts
+# this process's RSS when the step is started, so nothing large (pandas,
+# or the synthetic inputs) is loaded here while benchmarking.  Inputs are
+# generated by a separate process.
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SCRIPTS = os.path.join(ROOT, 'scripts')
+RESULTS_PATH = os.path.join(ROOT, 'res', 'benchmark.tsv')
+WORK_DIR = os.path.join(ROOT, 'build', 'benchmark')
+
+RESULT_COLS = [ 'commit'
+              , 'started'
+              , 'host'
+              , 'step'
+              , 'scale'
+              , 'status'
+              , 'wall_seconds'
+              , 'user_seconds'
+              , 'system_seconds'
+              , 'max_rss_mib'
+              , 'input_bytes'
+              , 'output_bytes'
+              ]
+
+METADATA_TABLES = [ 'mouse', 'sample', 'extraction', 'molecule', 'standard'
+                  , 'known', 'injection', 'calibration_group'
+                  , 'calibration_config', 'primer', 'spike', 'rrs_library'
+                  , 'rrs_analysis_group'
+                  ]
+
+STEPS = [ 'parse_lcs_export', 'qc_hplc', 'import_db:metadata'
+        , 'calibrate_hplc', 'pivot_count_table', 'stack_shared'
+        , 'parse_otu_taxonomy', 'squeeze_alignment', 'import_db:results'
+        , 'load_data'
+        ]
+
+GENERATE = ("import json, sys; from lib import synthetic; "
+            "json.dump(synthetic.generate(sys.argv[1], int(sys.argv[2]), "
+            "seed=int(sys.argv[3])), sys.stdout)")
+
+LOAD_DATA = ("import sys; from scripts.lib.data import load_data; "
+             "data = load_data(sys.argv[1], use_cache=False); "
+             "[data[name] for name in data]")
+
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPTS, name)]
+
+
+def pipeline(inputs, work):
+    """An ordered dict of step name to (requires, command, inputs, output).
+
+    Steps are in the order of STEPS.  The command's stdout is written to
+    *output*, unless it's None.
+
+    """
+    meta = inputs['metadata']
+    out = lambda name: os.path.join(work, name)
+    steps = collections.OrderedDict()
+    steps['parse_lcs_export'] = (
+        [], script('parse_lcs_export.py') + ['--constant', 'channel=RI']
+        + inputs['exports'], inputs['exports'], out('peak.tsv'))
+    steps['qc_hplc'] = (
+        ['parse_lcs_export'],
+        script('qc_hplc.py') + [out('peak.tsv'), meta['molecule']],
+        [out('peak.tsv')], out('peak.qc.tsv'))
+    steps['import_db:metadata'] = (
+        [], script('import_db.py')
+        + ['--schema', os.path.join(ROOT, 'schema_metadata.sql')]
+        + [arg for table in METADATA_TABLES
+           for arg in ['-t', '{}={}'.format(table, meta[table])]]
+        + ['--db-out-path', out('metadata.db')],
+        [meta[table] for table in METADATA_TABLES], None)
+    steps['calibrate_hplc'] = (
+        ['parse_lcs_export', 'import_db:metadata'],
+        script('calibrate_hplc.py') + [out('metadata.db'), out('peak.tsv')],
+        [out('peak.tsv')], out('calibration.tsv'))
+    steps['pivot_count_table'] = (
+        [], script('pivot_count_table.py') + [inputs['count_table']],
+        [inputs['count_table']], out('unique.read_count.tsv'))
+    steps['stack_shared'] = (
+        [], script('stack_shared.py') + [inputs['shared']],
+        [inputs['shared']], out('otu.read_count.tsv'))
+    steps['parse_otu_taxonomy'] = (
+        [], script('parse_otu_taxonomy.py') + ['otu-0.03', inputs['taxonomy']],
+        [inputs['taxonomy']], out('otu.tax.tsv'))
+    steps['squeeze_alignment'] = (
+        [], script('squeeze_alignment.py') + ['-.', inputs['alignment']],
+        [inputs['alignment']], out('squeezed.align'))
+    steps['import_db:results'] = (
+        ['import_db:metadata', 'parse_lcs_export', 'qc_hplc',
+         'calibrate_hplc', 'stack_shared', 'parse_otu_taxonomy'],
+        script('import_db.py')
+        + ['--copy-from', out('metadata.db')]
+        + ['--schema', os.path.join(ROOT, 'schema_results.sql')]
+        + ['-t', 'peak=' + out('peak.tsv'),
+           '-t', 'peak_qc=' + out('peak.qc.tsv'),
+           '-t', 'calibration=' + out('calibration.tsv'),
+           '-t', '_rrs_library_taxon_count=' + out('otu.read_count.tsv'),
+           '-t', 'taxonomy=' + out('otu.tax.tsv'),
+           '-t', 'rrs_spike_strain_hit=' + inputs['spike_hits']]
+        + ['--db-out-path', out('results.db')],
+        [out('otu.read_count.tsv'), out('peak.tsv')], None)
+    steps['load_data'] = (
+        ['import_db:results'],
+        [sys.executable, '-c', LOAD_DATA, out('results.db')],
+        [out('results.db')], None)
+    assert list(steps) == STEPS
+    return steps
+
+
+def run(command, output=None):
+    """Run *command*, returning (returncode, wall seconds, resource usage).
+
+    Usage is of the command's process alone (from wait4), not of any other
+    children.
+
+    """
+    stdout = open(output, 'w') if output else subprocess.DEVNULL
+    start = time.perf_counter()
+    try:
+        proc = subprocess.Popen(command, stdout=stdout,
+                                stderr=subprocess.DEVNULL, cwd=ROOT)
+        _, status, usage = os.wait4(proc.pid, 0)
+        if os.WIFEXITED(status):
+            proc.returncode = os.WEXITSTATUS(status)
+        else:
+            proc.returncode = -os.WTERMSIG(status)
+    finally:
+        if output:
+            stdout.close()
+    return proc.returncode, time.perf_counter() - start, usage
+
+
+def file_size(path):
+    return os.path.getsize(path) if path and os.path.exists(path) else 0
+
+
+def max_rss_mib(usage):
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss / 2**20
+    return usage.ru_maxrss / 2**10
+
+
+def current_commit():
+    """Short hash of HEAD, marked '-dirty' if there are local changes."""
+    def git(*args):
+        return subprocess.check_output(['git'] + list(args), cwd=ROOT,
+                                       universal_newlines=True).strip()
+    try:
+        commit = git('rev-parse', '--short', 'HEAD')
+        if git('status', '--porcelain', '--untracked-files=no'):
+            commit += '-dirty'
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+    return commit
+
+
+def benchmark(scale, work_dir, selected=None, seed=0):
+    """Generate inputs at *scale* and yield a result dict for each step.
+
+    If *selected* is given, only those steps (and the steps they require)
+    are run.
+
+    """
+    work = os.path.join(work_dir, 'scale-{}'.format(scale))
+    if os.path.exists(work):
+        shutil.rmtree(work)
+    print("Generating inputs at scale {} in {}".format(scale, work),
+          file=sys.stderr)
+    inputs = json.loads(subprocess.check_output(
+            [sys.executable, '-c', GENERATE, os.path.join(work, 'input'),
+             str(scale), str(seed)], cwd=SCRIPTS, universal_newlines=True))
+    steps = pipeline(inputs, work)
+
+    needed = set(selected or steps)
+    for name in reversed(steps):
+        if name in needed:
+            needed.update(steps[name][0])
+
+    failed = set()
+    for name, (requires, command, step_inputs, output) in steps.items():
+        if name not in needed:
+            continue
+        result = {'step': name, 'scale': scale,
+                  'input_bytes': sum(file_size(p) for p in step_inputs)}
+        if failed.intersection(requires):
+            failed.add(name)
+            result['status'] = 'skipped'
+        else:
+            returncode, wall, usage = run(command, output)
+            if returncode:
+                failed.add(name)
+            result.update(status='ok' if returncode == 0 else 'failed',
+                          wall_seconds=wall,
+                          user_seconds=usage.ru_utime,
+                          system_seconds=usage.ru_stime,
+                          max_rss_mib=max_rss_mib(usage),
+                          output_bytes=file_size(output))
+        print("{step}\t{scale}\t{status}\t{wall:.2f}s\t{rss:.0f} MiB"
+              .format(wall=result.get('wall_seconds', float('nan')),
+                      rss=result.get('max_rss_mib', float('nan')),
+                      **result), file=sys.stderr)
+        yield result
+
+
+def append_results(results, path):
+    header = not os.path.exists(path)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as handle:
+        writer = csv.DictWriter(handle, RESULT_COLS, delimiter='\t',
+                                lineterminator='\n')
+        if header:
+            writer.writeheader()
+        writer.writerows(results)
+
+
+def report(path, metric):
+    import pandas as pd
+    results = pd.read_table(path)
+    results = results[results.status == 'ok']
+    commits = list(results.commit.drop_duplicates())
+    table = (results.groupby(['step', 'scale', 'commit'])[metric].median()
+                    .unstack('commit')
+                    .reindex(columns=commits))
+    return table
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--scale', type=int, nargs='+', default=[1],
+                   help='input sizes relative to the data (default: 1)')
+    p.add_argument('--step', nargs='+', metavar='STEP',
+                   help='run only these steps (and those they need)')
+    p.add_argument('--work-dir', default=WORK_DIR,
+                   help='where inputs and outputs are written')
+    p.add_argument('--results', default=RESULTS_PATH,
+                   help='TSV of results, appended to')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--keep', action='store_true',
+                   help="don't remove each scale's files when finished")
+    p.add_argument('--report', action='store_true',
+                   help='summarize RESULTS instead of running benchmarks')
+    p.add_argument('--metric', default='wall_seconds',
+                   choices=RESULT_COLS[6:],
+                   help='for --report (default: %(default)s)')
+    args = p.parse_args()
+
+    if args.report:
+        report(args.results, args.metric).to_csv(sys.stdout, sep='\t')
+        return
+
+    for name in args.step or []:
+        if name not in STEPS:
+            p.error('unknown step {!r} (choose from {})'
+                    .format(name, ', '.join(STEPS)))
+
+    shared = {'commit': current_commit(),
+              'started': datetime.datetime.now().isoformat(timespec='seconds'),
+              'host': platform.node()}
+    for scale in args.scale:
+        results = [dict(shared, **result)
+                   for result in benchmark(scale, args.work_dir,
+                                           selected=args.step, seed=args.seed)]
+        append_results(results, args.results)
+        if not args.keep:
+            shutil.rmtree(os.path.join(args.work_dir, 'scale-{}'.format(scale)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,54 +2,118 @@
 
 import pandas as pd
 import numpy as np
-import statsmodels.formula.api as sm
 import sqlite3
 import sys
+from lib import instrument
 
+GROUP_KEYS = ['molecule_id', 'channel', 'calibration_group']
+OUT_COLS = ['intercept', 'slope', 'limit_of_detection', 'observations',
+            'relative_standard_error', 'rsquared']
 
-def relative_standard_error(fit):
-    data = pd.DataFrame(dict(residual=fit.resid,
-                             fitted=fit.predict()))
-    data['deviation_ratio'] = data.residual / data.fitted
-    return np.sqrt(np.sum(data.deviation_ratio ** 2) / fit.df_resid)
+# Largest relative deviation of a standard from the curve (the same +/-10%
+# band drawn by plot_hplc_calibration.py) at or above the limit of detection.
+LOD_RELATIVE_ERROR = 0.10
 
-def get_calibration(data):
-    data = data.copy()
-    try:
-        data['weight'] = data.known_concentration ** -2
-    except ZeroDivisionError:
-        data['weight'] = np.nan
-    data = data.replace([np.inf, -np.inf], np.nan).dropna(subset=['weight', 'area'])
-    if not len(data) > 1:
-        return
+
+def segment_sum(codes, values, n):
+    return np.bincount(codes, weights=values, minlength=n)
+
+
+def limit_of_detection(data, threshold=LOD_RELATIVE_ERROR):
+    """Lowest known concentration with all higher standards within threshold.
+
+    *data* must have group `code`, `known_concentration` and
+    `deviation_ratio` columns.
+
+    """
+    level = (data.assign(deviation=data.deviation_ratio.abs())
+                 .groupby(['code', 'known_concentration'])
+                 .deviation.max()
+                 .reset_index()
+                 .sort_values(['code', 'known_concentration'],
+                              ascending=[True, False]))
+    level['worst'] = level.groupby('code').deviation.cummax()
+    within = level[level.worst <= threshold]
+    return within.groupby('code').known_concentration.min()
+
+
+def calibrate(data):
+    """Fit weighted standard curves for every calibration group at once.
+
+    Each (molecule_id, channel, calibration_group) gets a weighted least
+    squares fit of area on known_concentration, with weights
+    known_concentration ** -2 and an intercept only if calibration_config
+    asks for one.  Groups with fewer than two usable standards are left
+    empty (all NaN).
+
+    """
+    data = data[GROUP_KEYS + ['known_concentration', 'area', 'intercept']]
+    all_groups = data.groupby(GROUP_KEYS, sort=True).size().index
+    with np.errstate(divide='ignore'):
+        weight = data.known_concentration.astype(float) ** -2
+    data = (data.assign(weight=weight)
+                .replace([np.inf, -np.inf], np.nan)
+                .dropna(subset=['weight', 'area']))
+    grouped = data.groupby(GROUP_KEYS, sort=True)
+    size = grouped.size()
+    group_codes = grouped.ngroup().values
+
+    # Number the groups with at least two standards 0..n_groups-1.
+    keep = size.values > 1
+    rows = keep[group_codes]
+    codes = (np.cumsum(keep) - 1)[group_codes[rows]]
+    data = data[rows].assign(code=codes)
+    groups = size.index[keep]
+    n_groups = len(groups)
 
     # Deal with presence/absence of an intercept term according to calibration_config
-    _intercept = data.intercept.unique()
-    assert len(_intercept) == 1
-    intercept = _intercept[0]
-
-    try:
-        if intercept == 0:
-            fit = sm.wls('area ~ known_concentration - 1', data=data, weights=data.weight).fit()
-        else:
-            fit = sm.wls('area ~ known_concentration', data=data, weights=data.weight).fit()
-    except ValueError as err:
-        print(data, file=sys.stderr)
-        raise err
-
-    out = {}
-    if hasattr(fit.params, 'Intercept'):
-        out['intercept'] = fit.params.Intercept
-        out['slope'] = fit.params[1]
-    else:
-        out['intercept'] = 0
-        out['slope'] = fit.params[0]
-    out['limit_of_detection'] = np.nan  # TODO
-    out['observations'] = fit.nobs
-    out['relative_standard_error'] = relative_standard_error(fit)
-    out['rsquared'] = fit.rsquared
-
-    return pd.Series(out)
+    assert (data.groupby('code').intercept.nunique() == 1).all()
+    has_intercept = (data.groupby('code').intercept.first().values != 0)
+
+    x = data.known_concentration.values.astype(float)
+    y = data.area.values.astype(float)
+    w = data.weight.values
+    nobs = segment_sum(codes, None, n_groups).astype(float)
+    sum_w = segment_sum(codes, w, n_groups)
+    x_mean = segment_sum(codes, w * x, n_groups) / sum_w
+    y_mean = segment_sum(codes, w * y, n_groups) / sum_w
+
+    # Without an intercept, regress through the origin.
+    x_center = np.where(has_intercept, x_mean, 0)[codes]
+    y_center = np.where(has_intercept, y_mean, 0)[codes]
+    dx, dy = x - x_center, y - y_center
+    slope = (segment_sum(codes, w * dx * dy, n_groups)
+             / segment_sum(codes, w * dx * dx, n_groups))
+    intercept = np.where(has_intercept, y_mean - slope * x_mean, 0)
+
+    fitted = intercept[codes] + slope[codes] * x
+    resid = y - fitted
+    df_resid = nobs - np.where(has_intercept, 2, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviation_ratio = resid / fitted
+        rse = np.sqrt(segment_sum(codes, deviation_ratio ** 2, n_groups)
+                      / df_resid)
+
+    # R-squared is centered only if the model has a constant term; like
+    # statsmodels, a constant known_concentration also counts as one.
+    x_range = (data.groupby('code').known_concentration.max()
+               - data.groupby('code').known_concentration.min()).values
+    centered = has_intercept | (x_range == 0)
+    ssr = segment_sum(codes, w * resid ** 2, n_groups)
+    tss = np.where(centered,
+                   segment_sum(codes, w * (y - y_mean[codes]) ** 2, n_groups),
+                   segment_sum(codes, w * y ** 2, n_groups))
+
+    out = pd.DataFrame({'intercept': intercept.astype(float),
+                        'slope': slope,
+                        'observations': nobs,
+                        'relative_standard_error': rse,
+                        'rsquared': 1 - ssr / tss},
+                       index=groups)
+    lod = limit_of_detection(data.assign(deviation_ratio=deviation_ratio))
+    out['limit_of_detection'] = np.nan
+    out.iloc[lod.index, out.columns.get_loc('limit_of_detection')] = lod.values
+    return out[OUT_COLS].reindex(all_groups)
 
 def main():
     con = sqlite3.connect(sys.argv[1])
@@ -61,12 +125,16 @@ def main():
         JOIN calibration_config
           USING (molecule_id)
     """
-    meta = pd.read_sql(meta_query, con=con)
-    peak = pd.read_table(sys.argv[2])
-    data = peak.merge(meta, on=['injection_id', 'molecule_id', 'channel'])
-    calibration = (data.groupby(['molecule_id', 'channel', 'calibration_group'])
-                       .apply(get_calibration))
-    calibration.to_csv(sys.stdout, sep='\t')
+    with instrument.stage('read') as stage:
+        meta = pd.read_sql(meta_query, con=con)
+        peak = pd.read_table(sys.argv[2])
+        data = peak.merge(meta, on=['injection_id', 'molecule_id', 'channel'])
+        stage.rows = len(data)
+    with instrument.stage('calibrate') as stage:
+        calibration = calibrate(data)
+        stage.rows = len(calibration)
+    with instrument.stage('write'):
+        calibration.to_csv(sys.stdout, sep='\t')
 
 if __name__ == '__main__':
     main()
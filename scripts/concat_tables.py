@@ -4,22 +4,68 @@
 Columns do not need to be in the same order, but they do need to have the same
 header.
 
+All headers are read first; the output has the columns of the first table
+(followed by any extra columns from later tables, which are left empty
+elsewhere).  Rows are then streamed from each table in turn, with their
+fields reordered to match, so memory use doesn't depend on the table sizes.
+Quoted fields are kept (and quoted again as needed), and blank lines are
+skipped.
+
 usage:
 
     concat_tables.py TABLE1 TABLE2 ... > OUTPUT
 
 """
 
+import csv
+import io
 import pandas as pd
 import sys
 
-def get_tables(paths):
-    for p in paths:
-        try:
-            yield pd.read_table(p)
-        except pd.io.common.EmptyDataError as err:
-            print(p, file=sys.stderr)
-            raise err
+BUFFER_SIZE = 2**22
+
+
+def read_header(path):
+    try:
+        return list(pd.read_table(path, nrows=0).columns)
+    except pd.errors.EmptyDataError as err:
+        print(path, file=sys.stderr)
+        raise err
+
+
+def output_columns(headers):
+    columns = []
+    for header in headers:
+        columns.extend(c for c in header if c not in columns)
+    return columns
+
+
+def iter_rows(path, header, columns):
+    """Yield the rows of *path* as lists of fields ordered as *columns*."""
+    position = {c: i for i, c in enumerate(header)}
+    order = [position.get(c) for c in columns]
+    with open(path, newline='') as handle:
+        reader = csv.reader(handle, delimiter='\t')
+        next(reader, None)
+        for fields in reader:
+            if not fields:
+                continue
+            # Like read_table, missing trailing fields are left empty.
+            yield ['' if i is None or i >= len(fields) else fields[i]
+                   for i in order]
+
+
+def main():
+    paths = sys.argv[1:]
+    headers = [read_header(p) for p in paths]
+    columns = output_columns(headers)
+    with io.open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE,
+                 closefd=False) as out:
+        writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+        writer.writerow(columns)
+        for path, header in zip(paths, headers):
+            writer.writerows(iter_rows(path, header, columns))
+
 
-tables = get_tables(sys.argv[1:])
-pd.concat(tables).to_csv(sys.stdout, sep='\t', index=False)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Report full table scans and temporary B-trees in query plans.
+
+Runs EXPLAIN QUERY PLAN against DB for every view defined in the schema
+scripts (or every view in DB, if none are given), and for every SQL query
+found in the Python modules (string literals starting with SELECT).  Plan
+steps that scan a whole table (or index) or build a temporary B-tree (for
+GROUP BY, ORDER BY or DISTINCT) are written to stdout as a TSV, with a
+per-query summary on stderr.
+
+usage:
+
+    explain_queries.py [--schema SQL ...] [--module PY ...] [--all] DB
+
+"""
+
+import argparse
+import ast
+import re
+import sqlite3
+import sys
+
+VIEW_PATTERN = re.compile(r'CREATE\s+VIEW\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)',
+                          flags=re.IGNORECASE)
+SCAN_PATTERN = re.compile(r'^SCAN\b')
+TEMP_PATTERN = re.compile(r'\bUSE TEMP B-TREE\b')
+INDEX_SCAN_PATTERN = re.compile(r'\bUSING (COVERING )?INDEX\b')
+
+
+def schema_views(handle):
+    return VIEW_PATTERN.findall(handle.read())
+
+
+def module_queries(path):
+    """Yield (name, query) for each SELECT string literal in a Python module."""
+    with open(path) as handle:
+        tree = ast.parse(handle.read(), filename=path)
+    for node in ast.walk(tree):
+        if type(node).__name__ == 'Str':  # Python < 3.8
+            value = node.s
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str):
+            value = node.value
+        else:
+            continue
+        if value.strip().upper().startswith('SELECT'):
+            yield '{}:{}'.format(path, node.lineno), value
+
+
+def classify(detail):
+    """Describe the problem with a plan step, or return None."""
+    if TEMP_PATTERN.search(detail):
+        return 'temp b-tree'
+    if SCAN_PATTERN.search(detail):
+        if INDEX_SCAN_PATTERN.search(detail):
+            return 'full index scan'
+        return 'full scan'
+    return None
+
+
+def explain(con, query):
+    """Return the plan as a list of (id, parent, detail)."""
+    return [(row[0], row[1], row[-1])
+            for row in con.execute('EXPLAIN QUERY PLAN ' + query)]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--schema', '-s', type=argparse.FileType('r'),
+                   action='append', default=[], metavar='SQL',
+                   help='explain the views created in this SQL script')
+    p.add_argument('--module', '-m', action='append', default=[],
+                   metavar='PY', help='explain the queries in this module')
+    p.add_argument('--all', action='store_true',
+                   help='write every plan step, not just the problems')
+    p.add_argument('database', metavar='DB')
+    args = p.parse_args()
+
+    con = sqlite3.connect(args.database)
+    queries = []
+    if args.schema:
+        views = [view for handle in args.schema
+                 for view in schema_views(handle)]
+    else:
+        views = [name for name, in con.execute("SELECT name FROM sqlite_master "
+                                               "WHERE type = 'view'")]
+    for view in views:
+        queries.append((view, 'SELECT * FROM {}'.format(view)))
+    for path in args.module:
+        queries.extend(module_queries(path))
+
+    print('query', 'step', 'parent', 'problem', 'detail', sep='\t')
+    for name, query in queries:
+        try:
+            plan = explain(con, query)
+        except sqlite3.Error as err:
+            print("Could not explain {}: {}".format(name, err),
+                  file=sys.stderr)
+            continue
+        problems = 0
+        for step, parent, detail in plan:
+            problem = classify(detail)
+            if problem:
+                problems += 1
+            if problem or args.all:
+                print(name, step, parent, problem or '', detail, sep='\t')
+        print("{}: {} of {} plan steps are full scans or temp b-trees."
+              .format(name, problems, len(plan)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
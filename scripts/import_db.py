@@ -1,16 +1,283 @@
 #!/usr/bin/env python3
+"""Build an SQLite database from SQL scripts and TSV tables.
+
+The database is written to a temporary file next to *--db-out-path*, with
+journaling and syncing turned off, all rows inserted in a single
+transaction, and any CREATE INDEX statements from the scripts deferred until
+after the data is loaded.  If the schema has the tables of library totals
+and taxon incidence, they are filled by tally_rrs_totals.py after the indexes
+are built.  The finished file is then renamed into place.
+
+A manifest of source file hashes is stored in the database.  With
+--incremental, an existing database built from the same scripts is updated in
+place: only tables whose source changed are re-imported, along with the
+tables that reference them (directly or indirectly) through foreign keys.
+The totals are tallied again whenever one of the tables they are read from
+is re-imported, so they are never out of date.
+
+usage:
+
+    import_db.py --schema SCHEMA.sql -t TABLE=PATH ... --db-out-path OUT.db
+
+"""
 
 import pandas as pd
 import sys
 import sqlite3
 import collections
 import argparse
+import hashlib
+import re
 import os
+from lib import instrument
+import tally_rrs_totals
+
+BATCH_SIZE = 10000
+DEFAULT_CACHE_SIZE = 1000000  # pages
+HASH_CHUNK_SIZE = 2**20
+
+MANIFEST_TABLE = '_import_manifest'
+SCHEMA_KEY = ':schema'  # Manifest entry for the scripts and --copy-from schema
+
+INDEX_PATTERN = re.compile(r'^(\s*(--[^\n]*\n|/\*.*?\*/))*\s*'
+                           r'CREATE\s+(UNIQUE\s+)?INDEX\b',
+                           flags=re.IGNORECASE | re.DOTALL)
+
+
+def split_statements(script):
+    """Split an SQL script into complete statements."""
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+    if statement.strip():
+        yield statement
+
+
+def split_indexes(script):
+    """Separate CREATE INDEX statements from the rest of an SQL script.
+
+    Returns a tuple of (script without indexes, list of index statements).
+
+    """
+    body, indexes = [], []
+    for statement in split_statements(script):
+        if INDEX_PATTERN.match(statement):
+            indexes.append(statement)
+        else:
+            body.append(statement)
+    return ''.join(body), indexes
+
+
+def iter_batches(df, size=BATCH_SIZE):
+    """Yield lists of row tuples, with NaN replaced by None.
+
+    Columns are converted separately, so integer columns aren't cast to
+    float alongside float columns.
+
+    """
+    for start in range(0, len(df), size):
+        chunk = df.iloc[start:start + size]
+        columns = [chunk[col].astype(object).where(chunk[col].notnull(), None)
+                   for col in chunk]
+        yield list(zip(*columns))
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(conn):
+    """Return {name: digest} from the manifest, or {} if there is none."""
+    try:
+        return dict(conn.execute('SELECT name, digest FROM {}'
+                                 .format(MANIFEST_TABLE)))
+    except sqlite3.OperationalError:
+        return {}
+
+
+def write_manifest(conn, entries):
+    conn.execute('CREATE TABLE IF NOT EXISTS {} '
+                 '(name TEXT PRIMARY KEY, digest TEXT)'.format(MANIFEST_TABLE))
+    conn.executemany('INSERT OR REPLACE INTO {} (name, digest) VALUES (?, ?)'
+                     .format(MANIFEST_TABLE), entries.items())
+
+
+def dependents(conn, tables):
+    """Find all tables that reference *tables* through foreign keys."""
+    children = collections.defaultdict(set)
+    names = [name for name, in conn.execute("SELECT name FROM sqlite_master "
+                                            "WHERE type = 'table'")]
+    for child in names:
+        for row in conn.execute('PRAGMA foreign_key_list("{}")'.format(child)):
+            children[row[2]].add(child)
+
+    found = set()
+    stack = list(tables)
+    while stack:
+        for child in children[stack.pop()]:
+            if child not in found:
+                found.add(child)
+                stack.append(child)
+    return found - set(tables)
+
+
+def import_table(conn, table, path):
+    df = pd.read_table(path)
+    statement = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            table,
+            ', '.join('"{}"'.format(c) for c in df.columns),
+            ', '.join('?' for _ in df.columns))
+    for batch in iter_batches(df):
+        conn.executemany(statement, batch)
+    return len(df)
+
+
+def import_logged(conn, table, path):
+    """Import *table*, reporting the row count (or the table, on errors)."""
+    with instrument.stage('import:' + table) as stage:
+        try:
+            stage.rows = import_table(conn, table, path)
+        except sqlite3.Error as err:
+            print("Error while import table {}".format(table), file=sys.stderr)
+            raise err
+    print("Imported {} rows into {}.".format(stage.rows, table),
+          file=sys.stderr)
+
+
+def report_foreign_keys(conn):
+    violations = collections.Counter(
+            (table, parent) for table, _, parent, _
+            in conn.execute('PRAGMA foreign_key_check'))
+    for (table, parent), count in sorted(violations.items()):
+        print("{} rows in {} violate a foreign key to {}."
+              .format(count, table, parent), file=sys.stderr)
+
+
+def build(args, scripts, table_map, manifest):
+    """Write a new database from scratch and rename it into place."""
+    if args.db_out_path != ':memory:':
+        temp_path = args.db_out_path + '.temp'
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+    else:
+        temp_path = ':memory:'
+    conn = sqlite3.connect(temp_path, isolation_level=None)
+
+    try:
+        with instrument.stage('schema'):
+            if args.copy_from:
+                source = sqlite3.connect(args.copy_from)
+                source.backup(conn)
+                source.close()
+
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.execute('PRAGMA cache_size = {:d}'.format(args.cache_size))
+
+            indexes = []
+            for script in scripts:
+                script, script_indexes = split_indexes(script)
+                conn.executescript(script)
+                indexes.extend(script_indexes)
+
+        # Foreign keys are checked once, after loading, instead of per row.
+        conn.execute('PRAGMA foreign_keys = OFF')
+        conn.execute('BEGIN')
+        for table in table_map:
+            import_logged(conn, table, table_map[table])
+        with instrument.stage('index'):
+            for statement in indexes:
+                conn.execute(statement)
+        if tally_rrs_totals.has_tables(conn):
+            tally_rrs_totals.refresh(conn)
+        write_manifest(conn, manifest)
+        conn.execute('COMMIT')
+
+        with instrument.stage('check'):
+            report_foreign_keys(conn)
+            conn.execute('ANALYZE')
+
+        # Dump the sql script
+        if args.dump_sql:
+            for line in conn.iterdump():
+                print(line, file=sys.stdout)
+
+        conn.close()
+    except BaseException:
+        conn.close()
+        if temp_path != ':memory:' and os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if temp_path != ':memory:':
+        os.replace(temp_path, args.db_out_path)
+
+
+def refresh(conn, args, table_map, copied, manifest):
+    """Re-import changed tables (and their dependents) in place.
+
+    *copied* lists the tables that come from --copy-from.  The library totals
+    are tallied again if any of their sources were re-imported.
+
+    """
+    old_manifest = read_manifest(conn)
+    changed = {name for name, digest in manifest.items()
+               if old_manifest.get(name) != digest}
+    stale = changed | dependents(conn, changed)
+    for table in sorted(stale & set(old_manifest)
+                        - set(table_map) - set(copied)):
+        print("Cannot refresh {}; it is no longer imported.".format(table),
+              file=sys.stderr)
+
+    conn.execute('PRAGMA cache_size = {:d}'.format(args.cache_size))
+    conn.execute('PRAGMA foreign_keys = OFF')
+    if args.copy_from:
+        conn.execute('ATTACH DATABASE ? AS source', (args.copy_from,))
+    conn.execute('BEGIN')
+    for table in copied:
+        if table in stale:
+            conn.execute('DELETE FROM "{0}"'.format(table))
+            conn.execute('INSERT INTO "{0}" SELECT * FROM source."{0}"'
+                         .format(table))
+            print("Copied {} from {}.".format(table, args.copy_from),
+                  file=sys.stderr)
+    for table in table_map:
+        if table in stale:
+            conn.execute('DELETE FROM "{}"'.format(table))
+            import_logged(conn, table, table_map[table])
+    if stale & tally_rrs_totals.SOURCES and tally_rrs_totals.has_tables(conn):
+        tally_rrs_totals.refresh(conn)
+    write_manifest(conn, manifest)
+    conn.execute('COMMIT')
+    if args.copy_from:
+        conn.execute('DETACH DATABASE source')
+
+    if stale:
+        with instrument.stage('check'):
+            report_foreign_keys(conn)
+            conn.execute('ANALYZE')
+    else:
+        print("All tables are up to date.", file=sys.stderr)
+    conn.close()
+    os.utime(args.db_out_path)
+
 
 def main():
-    p = argparse.ArgumentParser()
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--copy-from', metavar='DB',
+                   help='start from a copy of an existing database')
     p.add_argument('--script', '--schema', '--sql', '-s',
-                   type=argparse.FileType('r'), 
+                   type=argparse.FileType('r'),
                    action='append', default=[], metavar='SQL',
                    help='SQL script to run before importing tables')
     p.add_argument('--table', '-t',
@@ -20,6 +287,11 @@ def main():
     p.add_argument('--db-out-path',
                    help='database file (will be over-written)',
                    default=':memory:')
+    p.add_argument('--incremental', action='store_true',
+                   help=('update an existing --db-out-path in place, '
+                         're-importing only tables whose source changed'))
+    p.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                   metavar='PAGES', help='SQLite page cache size while loading')
     p.add_argument('--dump-sql', help='dump SQL to stdout', action='store_true')
     args = p.parse_args()
 
@@ -29,36 +301,38 @@ def main():
         key, value = mapping.split('=')
         table_map[key.strip()] = value.strip()
 
-    if args.db_out_path != ':memory:':
-        try:
-            os.remove(args.db_out_path)
-        except FileNotFoundError:
-            pass
-        else:
-            print("Removing existing db file.", file=sys.stderr)
-    conn = sqlite3.connect(args.db_out_path)
-
-    curs = conn.cursor()
-    for handle in args.script:
-        script = handle.read()
-        curs.executescript(script)
-    curs.close()
+    scripts = [handle.read() for handle in args.script]
 
-    for table in table_map:
-        df = pd.read_table(table_map[table])
-        try:
-            df.to_sql(table, conn, if_exists='append', index=False)
-        except sqlite3.Error as err:
-            print("Error while import table {}".format(table), file=sys.stderr)
-            raise err
-        del df
+    # The manifest records a digest for each source table, plus one for the
+    # schema, which also covers the schema of any --copy-from database.
+    schema_digest = hashlib.sha1()
+    for script in scripts:
+        schema_digest.update(script.encode())
+    copied = collections.OrderedDict()
+    if args.copy_from:
+        source = sqlite3.connect(args.copy_from)
+        copied.update(read_manifest(source))
+        source.close()
+        if copied:
+            schema_digest.update(copied.pop(SCHEMA_KEY, '').encode())
+        else:  # Without a manifest, treat the whole file as schema.
+            schema_digest.update(file_digest(args.copy_from).encode())
+    manifest = collections.OrderedDict(copied)
+    manifest[SCHEMA_KEY] = schema_digest.hexdigest()
+    with instrument.stage('digest'):
+        for table in table_map:
+            manifest[table] = file_digest(table_map[table])
 
-    # Dump the sql script
-    if args.dump_sql:
-        for line in conn.iterdump():
-            print(line, file=sys.stdout)
+    if (args.incremental and args.db_out_path != ':memory:'
+            and os.path.exists(args.db_out_path)):
+        conn = sqlite3.connect(args.db_out_path, isolation_level=None)
+        if read_manifest(conn).get(SCHEMA_KEY) == manifest[SCHEMA_KEY]:
+            refresh(conn, args, table_map, copied, manifest)
+            return
+        conn.close()
+        print("Schema changed; rebuilding the database.", file=sys.stderr)
 
-    conn.close()
+    build(args, scripts, table_map, manifest)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+"""Columnar on-disk cache for DataFrames and sparse matrices.
+
+Each frame is stored as a directory of .npy files: the index, the column
+labels, and either one 2-D `values.npy` (frames with a single numeric dtype,
+like the OTU tables) or one file per column.  Sparse matrix.LabeledMatrix
+objects are stored as their CSR arrays.  Numeric arrays are
+memory-mapped (copy-on-write) when loaded, so opening even a large cached
+frame is nearly free.
+
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from . import matrix
+
+HASH_CHUNK_SIZE = 2**20
+META_FILE = 'meta.json'
+
+
+def file_digest(*paths):
+    """SHA-1 of the concatenated contents of *paths*."""
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_identity(path):
+    """A cheap fingerprint of *path* that changes whenever the file does."""
+    stat = os.stat(path)
+    return '{}-{}-{}'.format(stat.st_ino, stat.st_size,
+                             getattr(stat, 'st_mtime_ns', stat.st_mtime))
+
+
+def _save_array(path, array):
+    np.save(path, array, allow_pickle=(array.dtype.kind == 'O'))
+
+
+def _load_array(path):
+    # Object arrays are pickled and can't be memory-mapped.
+    try:
+        return np.load(path, mmap_mode='c')
+    except ValueError:
+        return np.load(path, allow_pickle=True)
+
+
+def save_frame(frame, path):
+    os.makedirs(path)
+    dtypes = set(frame.dtypes)
+    matrix = (len(dtypes) == 1 and dtypes.pop().kind in 'biuf')
+    meta = { 'index_name': frame.index.name
+           , 'columns_name': frame.columns.name
+           , 'layout': 'matrix' if matrix else 'columns'
+           }
+    _save_array(os.path.join(path, 'index.npy'), np.asarray(frame.index))
+    _save_array(os.path.join(path, 'columns.npy'),
+                np.asarray(frame.columns, dtype=object))
+    if matrix:
+        _save_array(os.path.join(path, 'values.npy'), frame.values)
+    else:
+        for i in range(frame.shape[1]):
+            _save_array(os.path.join(path, 'col{}.npy'.format(i)),
+                        np.asarray(frame.iloc[:, i]))
+    with open(os.path.join(path, META_FILE), 'w') as handle:
+        json.dump(meta, handle)
+
+
+def save_matrix(labeled, path):
+    os.makedirs(path)
+    meta = { 'index_name': labeled.index.name
+           , 'columns_name': labeled.columns.name
+           , 'layout': 'csr'
+           }
+    _save_array(os.path.join(path, 'index.npy'), np.asarray(labeled.index))
+    _save_array(os.path.join(path, 'columns.npy'),
+                np.asarray(labeled.columns, dtype=object))
+    for name in ['data', 'indices', 'indptr']:
+        _save_array(os.path.join(path, name + '.npy'),
+                    getattr(labeled.matrix, name))
+    with open(os.path.join(path, META_FILE), 'w') as handle:
+        json.dump(meta, handle)
+
+
+def load_frame(path):
+    """Load a frame (or LabeledMatrix) written by save_frame (save_matrix)."""
+    with open(os.path.join(path, META_FILE)) as handle:
+        meta = json.load(handle)
+    index = pd.Index(_load_array(os.path.join(path, 'index.npy')),
+                     name=meta['index_name'])
+    columns = pd.Index(list(_load_array(os.path.join(path, 'columns.npy'))),
+                       name=meta['columns_name'])
+    if meta['layout'] == 'csr':
+        arrays = [_load_array(os.path.join(path, name + '.npy'))
+                  for name in ['data', 'indices', 'indptr']]
+        csr = sparse.csr_matrix(tuple(arrays),
+                                shape=(len(index), len(columns)))
+        return matrix.LabeledMatrix(csr, index, columns)
+    if meta['layout'] == 'matrix':
+        return pd.DataFrame(_load_array(os.path.join(path, 'values.npy')),
+                            index=index, columns=columns, copy=False)
+    data = {i: _load_array(os.path.join(path, 'col{}.npy'.format(i)))
+            for i in range(len(columns))}
+    frame = pd.DataFrame(data, index=index, columns=list(range(len(columns))))
+    frame.columns = columns
+    return frame
+
+
+class FrameCache():
+    """A directory of cached frames (and small JSON-able objects) for one key.
+
+    Items are saved one at a time, each written to a temporary name and then
+    renamed into place.  Entries for other keys under the same *root* are
+    removed when the first item for a new key is saved, so only the latest
+    version is kept.
+
+    """
+    def __init__(self, root, key):
+        self.root = root
+        self.key = key
+        self.path = os.path.join(root, key)
+
+    def _object_path(self, name):
+        return os.path.join(self.path, name + '.json')
+
+    def __contains__(self, name):
+        return (os.path.isdir(os.path.join(self.path, name))
+                or os.path.isfile(self._object_path(name)))
+
+    def load(self, name):
+        if os.path.isdir(os.path.join(self.path, name)):
+            return load_frame(os.path.join(self.path, name))
+        with open(self._object_path(name)) as handle:
+            return json.load(handle)
+
+    def save(self, name, item):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, exist_ok=True)
+            for other in os.listdir(self.root):
+                if other != self.key and not other.startswith('.tmp-'):
+                    shutil.rmtree(os.path.join(self.root, other),
+                                  ignore_errors=True)
+        temp_path = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+        try:
+            if isinstance(item, pd.DataFrame):
+                save_frame(item, os.path.join(temp_path, name))
+                os.rename(os.path.join(temp_path, name),
+                          os.path.join(self.path, name))
+            elif isinstance(item, matrix.LabeledMatrix):
+                save_matrix(item, os.path.join(temp_path, name))
+                os.rename(os.path.join(temp_path, name),
+                          os.path.join(self.path, name))
+            else:
+                with open(os.path.join(temp_path, name), 'w') as handle:
+                    json.dump(item, handle)
+                os.replace(os.path.join(temp_path, name),
+                           self._object_path(name))
+        except OSError:
+            if name not in self:  # Unless another process beat us to it.
+                raise
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
@@ -1,8 +1,168 @@
+import collections
+import collections.abc
+import os
 import sqlite3
+import numpy as np
 import pandas as pd
+from . import cache
+from . import instrument
+from . import matrix
+from . import rollup
 
-def load_data(db_path):
-    con = sqlite3.connect(db_path)
+CACHE_SUFFIX = '.cache'
+
+# name: (names of the items it is computed from, loader function)
+LOADERS = collections.OrderedDict()
+
+
+def derives(name, *requires):
+    """Register a loader for *name*, computed from the items it *requires*.
+
+    The loader is called with the Dataset and then the required items.
+    Names starting with an underscore are internal: they aren't listed in
+    the Dataset's keys or cached on disk.
+
+    """
+    def register(func):
+        LOADERS[name] = (requires, func)
+        return func
+    return register
+
+
+class Dataset(collections.abc.Mapping):
+    """The standard analysis tables, loaded from the results database on demand.
+
+    Items are available both as keys (`data['mouse']`, for compatibility
+    with the dict load_data used to return) and attributes (`data.mouse`).
+    Each is computed the first time it's accessed, along with any items it
+    depends on, and kept in memory afterwards.  `con` is the open database
+    connection.
+
+    Unless *use_cache* is False, items are also cached in *cache_dir*
+    (default: next to the database, with a '.cache' suffix) as they're
+    computed, keyed by the database file's identity and the source of this
+    library.  Later Datasets load them from there (memory-mapped) until
+    either one changes.
+
+    With *sparse*, `abund`, `rabund` and `count` are matrix.LabeledMatrix
+    (CSR) objects instead of dense DataFrames; the family-level tables are
+    still (small) DataFrames.
+
+    """
+    def __init__(self, db_path, use_cache=True, cache_dir=None, sparse=False):
+        self.db_path = db_path
+        self.sparse = sparse
+        self.con = sqlite3.connect(db_path)
+        self._values = {'con': self.con}
+        self._store = None
+        if use_cache:
+            key = '{}-{}'.format(cache.file_identity(db_path),
+                                 cache.file_digest(__file__, cache.__file__,
+                                                   matrix.__file__,
+                                                   rollup.__file__)[:12])
+            root = os.path.join(cache_dir or db_path + CACHE_SUFFIX,
+                                'sparse' if sparse else 'dense')
+            self._store = cache.FrameCache(root, key)
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            if name not in LOADERS:
+                raise KeyError(name)
+            self._values[name] = self._load(name)
+        return self._values[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __iter__(self):
+        for name in LOADERS:
+            if not name.startswith('_'):
+                yield name
+        yield 'con'
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '<Dataset {}: {}>'.format(self.db_path, ', '.join(self))
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(self))
+
+    def _load(self, name):
+        cached = self._store is not None and not name.startswith('_')
+        if cached and name in self._store:
+            with instrument.stage('cache:' + name):
+                return self._store.load(name)
+        requires, func = LOADERS[name]
+        args = [self[required] for required in requires]
+        with instrument.stage('load:' + name) as stage:
+            value = func(self, *args)
+            if hasattr(value, 'shape'):
+                stage.rows = value.shape[0]
+        if cached:
+            with instrument.stage('save:' + name):
+                self._store.save(name, value)
+        return value
+
+    def loaded(self):
+        """Names of the items already in memory."""
+        return [name for name in self._values if not name.startswith('_')]
+
+    def dependents(self, name):
+        """All items computed (directly or indirectly) from *name*."""
+        found = set()
+        stack = [name]
+        while stack:
+            parent = stack.pop()
+            for child, (requires, _) in LOADERS.items():
+                if parent in requires and child not in found:
+                    found.add(child)
+                    stack.append(child)
+        return found
+
+    def forget(self, name):
+        """Drop *name*, and everything computed from it, from memory."""
+        for item in {name} | self.dependents(name):
+            self._values.pop(item, None)
+
+
+def load_data(db_path, use_cache=True, cache_dir=None, sparse=False):
+    """Open the standard analysis tables from the results database.
+
+    Returns a Dataset, which loads each table when it's first used; see
+    Dataset for the arguments.
+
+    """
+    return Dataset(db_path, use_cache=use_cache, cache_dir=cache_dir,
+                   sparse=sparse)
+
+
+def _read_otu_table(con, query, value):
+    """Read a sparse mouse x OTU table from *query*.
+
+    Like unstacking the long table, OTUs seen only in libraries without a
+    mouse_id are still included as (empty) columns.
+
+    """
+    long = pd.read_sql(query, con=con)
+    otus = pd.Index(long.taxon_id.unique(), name='taxon_id').sort_values()
+    long = long.dropna(subset=['mouse_id'])
+    libraries = long[['mouse_id', 'rrs_library_id']].drop_duplicates()
+    assert libraries.mouse_id.is_unique
+    mice = pd.Index(long.mouse_id.unique(), name='mouse_id').sort_values()
+    return matrix.LabeledMatrix.from_long(long.mouse_id, long.taxon_id,
+                                          long[value].values,
+                                          index=mice, column_index=otus)
+
+
+@derives('conc', 'mols', 'mol_c_count')
+def _conc(data, mols, mol_c_count):
     conc = (pd.read_sql(
         """
         SELECT mouse_id, molecule_id, concentration
@@ -16,14 +176,10 @@ def load_data(db_path):
                 OR (channel = 'RI' AND molecule_id = 'succinate')
             )
         """,
-        con=con, index_col=['mouse_id', 'molecule_id'])
+        con=data.con, index_col=['mouse_id', 'molecule_id'])
             ['concentration'].unstack('molecule_id', fill_value=0)
         )
 
-    mols = ['acetate', 'butyrate', 'succinate', 'lactate', 'propionate', 'glucose']
-    mol_c_count = {'acetate': 2, 'butyrate': 4, 'succinate': 4,
-                'lactate': 3, 'propionate': 3, 'glucose': 6}
-
     conc[[m + '_c' for m in mols]] = conc[mols].apply(lambda x: x * mol_c_count[x.name])
     conc['fermented_c'] = conc[[m + '_c' for m in mols]].drop('glucose_c', axis='columns').sum(axis='columns')
     conc[[m + '_frac' for m in mols]] = conc[mols].apply(lambda x: x / conc.fermented_c)
@@ -31,8 +187,23 @@ def load_data(db_path):
     conc['propionate_scfa_frac'] = conc.propionate / conc.total_scfa
     conc['butyrate_scfa_frac'] = conc.butyrate / conc.total_scfa
     conc['acetate_scfa_frac'] = conc.acetate / conc.total_scfa
+    return conc
+
+
+@derives('mols')
+def _mols(data):
+    return ['acetate', 'butyrate', 'succinate', 'lactate', 'propionate', 'glucose']
+
 
-    taxonomy = (pd.read_sql(
+@derives('mol_c_count')
+def _mol_c_count(data):
+    return {'acetate': 2, 'butyrate': 4, 'succinate': 4,
+            'lactate': 3, 'propionate': 3, 'glucose': 6}
+
+
+@derives('taxonomy')
+def _taxonomy(data):
+    return (pd.read_sql(
         """
         SELECT taxon_id AS otu_id, taxon_level_b AS level, taxon_id_b
         FROM taxonomy
@@ -41,18 +212,24 @@ def load_data(db_path):
         AND confidence > 0.7
         AND taxon_id_b NOT LIKE '%_unclassified'
         """,
-        con=con, index_col=['otu_id', 'level'])
+        con=data.con, index_col=['otu_id', 'level'])
                         .taxon_id_b.unstack('level')
                         [['phylum', 'class', 'order', 'family', 'genus']]
                         .apply(lambda x: x.str.replace('[-.]', '_')))
 
-    abund = (pd.read_sql("""
+
+@derives('abund')
+def _abund(data):
+    query = """
         SELECT mouse_id, rrs_library_id, taxon_id, absolute_abundance
         FROM rrs_library_taxon_absolute_abundance
         JOIN rrs_library_metadata USING (rrs_library_id)
         WHERE taxon_level = 'otu-0.03'
-                        """, con=con,
-                        index_col=['mouse_id', 'rrs_library_id', 'taxon_id'])
+            """
+    if data.sparse:
+        return _read_otu_table(data.con, query, 'absolute_abundance')
+    abund = (pd.read_sql(query, con=data.con,
+                         index_col=['mouse_id', 'rrs_library_id', 'taxon_id'])
             # Reshape into wide-format
             ['absolute_abundance'].unstack().fillna(0)
             # Drop libraries without an associated mouse_id
@@ -60,18 +237,40 @@ def load_data(db_path):
             .drop('rrs_library_id', axis='columns')
             )
     assert abund.index.is_unique
+    return abund
+
 
-    rabund = abund.apply(lambda x: x / x.sum(), axis='columns')
+@derives('rabund', 'abund')
+def _rabund(data, abund):
+    if data.sparse:
+        with np.errstate(divide='ignore'):
+            return abund.scale_rows(1 / abund.sum(axis='columns').values)
+    return abund.apply(lambda x: x / x.sum(), axis='columns')
 
-    abund_family = abund.groupby(taxonomy.family, axis=1).sum()
-    abund_family['unclassified'] = (abund.sum(axis=1) - abund_family.sum(axis=1))
-    abund_family.unclassified[abund_family.unclassified < 0] = 0
-    rabund_family = rabund.groupby(taxonomy.family, axis=1).sum()
-    rabund_family['unclassified'] = 1 - rabund_family.sum(axis=1)
-    rabund_family.unclassified[rabund_family.unclassified < 0] = 0
 
-    families = list(abund_family.columns)
+@derives('_rollup', 'taxonomy', 'abund')
+def _rollup(data, taxonomy, abund):
+    # Sums OTUs by family, with the remainder as 'unclassified'.
+    return rollup.TaxonRollup(taxonomy, abund.columns)
 
+
+@derives('abund_family', '_rollup', 'abund')
+def _abund_family(data, ranks, abund):
+    return ranks.aggregate(abund, clip=True)['family']
+
+
+@derives('rabund_family', '_rollup', 'rabund')
+def _rabund_family(data, ranks, rabund):
+    return ranks.aggregate(rabund, total=1, clip=True)['family']
+
+
+@derives('families', 'abund_family')
+def _families(data, abund_family):
+    return list(abund_family.columns)
+
+
+@derives('mouse', 'sample')
+def _mouse(data, sample):
     mouse = pd.read_sql(
         """
         SELECT
@@ -85,10 +284,26 @@ def load_data(db_path):
         , censored
         FROM mouse
         WHERE mouse_id NOT NULL
-        """, con=con, index_col='mouse_id')
+        """, con=data.con, index_col='mouse_id')
     mouse.site = mouse.site.apply(lambda x: 'TJL' if x == 'JL' else x)
 
-    sample = pd.read_sql(
+    mouse = mouse.join(sample, how='left')
+    assert mouse.index.is_unique
+    assert len(mouse.censored.unique()) <= 3  # Only 1.0, 0.0, and NaN
+    mouse['dead'] = mouse['censored'].map({1.0: False, 0.0: True})
+    mouse.drop('censored', axis='columns', inplace=True)
+    return mouse
+
+
+@derives('dens', 'abund')
+def _dens(data, abund):
+    # Total bacterial density of each mouse; join onto mouse as needed.
+    return abund.sum(axis='columns').to_frame('dens')
+
+
+@derives('sample')
+def _sample(data):
+    return pd.read_sql(
         """
         SELECT
             sample_id
@@ -103,22 +318,22 @@ def load_data(db_path):
             GROUP BY mouse_id
             ) USING (mouse_id)
         WHERE age_at_collect = max_age_at_collect
-        """, con=con, index_col='mouse_id')
+        """, con=data.con, index_col='mouse_id')
 
-    mouse = mouse.join(sample, how='left')
-    assert mouse.index.is_unique
-    assert len(mouse.censored.unique()) <= 3  # Only 1.0, 0.0, and NaN
-    mouse['dead'] = mouse['censored'].map({1.0: False, 0.0: True})
-    mouse.drop('censored', axis='columns', inplace=True)
-    mouse['dens'] = abund.sum(axis='columns')
-    count = (pd.read_sql("""
+
+@derives('count')
+def _count(data):
+    query = """
         SELECT mouse_id, rrs_library_id, taxon_id, tally
         FROM rrs_library_taxon_count
         JOIN rrs_library_metadata USING (rrs_library_id)
         WHERE taxon_level = 'otu-0.03'
         AND spike_id NOT NULL
-                        """, con=con,
-                        index_col=['mouse_id', 'rrs_library_id', 'taxon_id'])
+            """
+    if data.sparse:
+        return _read_otu_table(data.con, query, 'tally').astype(int)
+    count = (pd.read_sql(query, con=data.con,
+                         index_col=['mouse_id', 'rrs_library_id', 'taxon_id'])
             # Reshape into wide-format
             ['tally'].unstack().fillna(0).astype(int)
             # Drop libraries without an associated mouse_id
@@ -126,22 +341,9 @@ def load_data(db_path):
             .drop('rrs_library_id', axis='columns')
             )
     assert count.index.is_unique
+    return count
+
 
-    count_family = count.groupby(taxonomy.family, axis=1).sum()
-    count_family['unclassified'] = (count.sum(axis=1) - count_family.sum(axis=1))
-
-    return { 'con': con
-           , 'conc': conc
-           , 'mols': mols
-           , 'mol_c_count': mol_c_count
-           , 'taxonomy': taxonomy
-           , 'abund': abund
-           , 'rabund': rabund
-           , 'abund_family': abund_family
-           , 'rabund_family': rabund_family
-           , 'families': families
-           , 'mouse': mouse
-           , 'sample': sample
-           , 'count': count
-           , 'count_family': count_family
-           }
+@derives('count_family', '_rollup', 'count')
+def _count_family(data, ranks, count):
+    return ranks.aggregate(count)['family']
@@ -0,0 +1,296 @@
+"""Pairwise community distances, computed in blocks to a memory-mapped file.
+
+`pairwise` splits the rows of an abundance table (a DataFrame, ndarray,
+scipy.sparse matrix or matrix.LabeledMatrix) into blocks and computes each
+pair of blocks with scipy's cdist, on only the columns where either block
+has a nonzero value.  Blocks are written straight into a condensed distance
+matrix (the upper triangle, as from pdist) in a memory-mapped file, so the
+full n x n matrix is never held in memory; with *procs* > 1, strips of
+blocks are computed across a process pool.
+
+The Distances it returns can be used by `pcoa` and `betadisper`, which only
+stream rows of the (squared, Gower-centered) matrix, and by
+stats.permanova.
+
+"""
+import collections
+import multiprocessing
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
+from scipy.spatial import distance as sp_distance
+from scipy import stats as sp_stats
+from . import matrix
+
+METRICS = ['braycurtis', 'jaccard', 'euclidean']
+BLOCK_SIZE = 512  # rows
+DENSE_EIGEN_SIZE = 500  # Below this many rows, PCoA uses a dense solver.
+
+Ordination = collections.namedtuple('Ordination',
+                                    ['samples', 'eigvals',
+                                     'proportion_explained'])
+
+
+def condensed_index(n, i, j):
+    """Position of (i, j), with i < j, in a condensed n x n matrix."""
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+class Distances():
+    """A condensed distance matrix (usually memory-mapped) with labels."""
+    def __init__(self, condensed, index, path=None):
+        self.condensed = condensed
+        self.index = pd.Index(index)
+        self.path = path
+        self._row_means = None
+        n = len(self.index)
+        assert len(condensed) == n * (n - 1) // 2
+
+    def __len__(self):
+        return len(self.index)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.condensed, dtype=dtype)
+
+    def rows(self, rows):
+        """Square rows of the matrix, as an array of len(*rows*) x n."""
+        n = len(self)
+        rows = np.asarray(rows)[:, None]
+        cols = np.arange(n)[None, :]
+        i, j = np.minimum(rows, cols), np.maximum(rows, cols)
+        # The diagonal isn't stored; read any element there, then zero it.
+        position = np.minimum(condensed_index(n, i, j),
+                              len(self.condensed) - 1)
+        out = self.condensed[np.maximum(position, 0)]
+        out[i == j] = 0
+        return out
+
+    def iter_blocks(self, block_size=BLOCK_SIZE):
+        """Yield (row indices, square rows) for each block of rows."""
+        for start in range(0, len(self), block_size):
+            rows = np.arange(start, min(start + block_size, len(self)))
+            yield rows, self.rows(rows)
+
+    def to_frame(self):
+        """The square matrix as a DataFrame (only for small matrices)."""
+        return pd.DataFrame(sp_distance.squareform(np.asarray(self)),
+                            index=self.index, columns=self.index)
+
+    def row_means_sq(self):
+        """Mean squared distance from each row to every other."""
+        if self._row_means is None:
+            means = np.empty(len(self))
+            for rows, block in self.iter_blocks():
+                means[rows] = (block ** 2).mean(axis=1)
+            self._row_means = means
+        return self._row_means
+
+    def gower_dot(self, x):
+        """G @ *x*, where G = -(1/2) C D**2 C is the Gower-centered matrix.
+
+        *x* is a vector or an (n x k) array.  D is streamed in blocks of rows.
+
+        """
+        x = np.asarray(x, dtype=float)
+        r = self.row_means_sq()
+        m = r.mean()
+        col_sum = x.sum(axis=0)
+        out = np.empty_like(x)
+        for rows, block in self.iter_blocks():
+            out[rows] = (block ** 2) @ x
+        out -= np.outer(r, col_sum).reshape(out.shape)
+        out -= (r @ x)[None] if x.ndim > 1 else r @ x
+        out += m * col_sum
+        return -0.5 * out
+
+    def gower_diagonal(self):
+        r = self.row_means_sq()
+        return r - r.mean() / 2
+
+    def __repr__(self):
+        return '<Distances {0}x{0}{1}>'.format(
+                len(self), ' at ' + self.path if self.path else '')
+
+
+def _as_table(table):
+    """Return (CSR matrix or ndarray, row labels) for an abundance table."""
+    if isinstance(table, matrix.LabeledMatrix):
+        return table.matrix, table.index
+    if isinstance(table, pd.DataFrame):
+        return table.values.astype(float), table.index
+    if sparse.issparse(table):
+        return sparse.csr_matrix(table), pd.RangeIndex(table.shape[0])
+    table = np.asarray(table, dtype=float)
+    return table, pd.RangeIndex(table.shape[0])
+
+
+def _block_pair(values, rows_a, rows_b, metric):
+    """Distances between two blocks of rows, on their nonzero columns only."""
+    a, b = values[rows_a], values[rows_b]
+    if sparse.issparse(values):
+        support = np.union1d(a.indices, b.indices)
+        a, b = a[:, support].toarray(), b[:, support].toarray()
+    else:
+        support = (a != 0).any(axis=0) | (b != 0).any(axis=0)
+        a, b = a[:, support], b[:, support]
+    if metric == 'jaccard':
+        a, b = a != 0, b != 0
+    if a.shape[1] == 0:
+        a, b = np.zeros((len(a), 1)), np.zeros((len(b), 1))
+    return sp_distance.cdist(a, b, metric)
+
+
+_WORKER = {}
+
+
+def _init_worker(values, path, n, metric, block_size):
+    _WORKER.update(values=values, path=path, n=n, metric=metric,
+                   block_size=block_size)
+
+
+def _compute_strip(start):
+    """Write the distances from one block of rows to all later rows."""
+    state = _WORKER
+    n, block_size = state['n'], state['block_size']
+    out = np.memmap(state['path'], dtype=float, mode='r+',
+                    shape=(n * (n - 1) // 2,))
+    rows_a = np.arange(start, min(start + block_size, n))
+    for other in range(start, n, block_size):
+        rows_b = np.arange(other, min(other + block_size, n))
+        block = _block_pair(state['values'], rows_a, rows_b, state['metric'])
+        for k, i in enumerate(rows_a):
+            # Only the upper triangle (j > i) is stored.
+            cols = rows_b > i
+            if not cols.any():
+                continue
+            first = condensed_index(n, i, rows_b[cols][0])
+            out[first:first + cols.sum()] = block[k, cols]
+    out.flush()
+    del out
+
+
+def pairwise(table, metric='braycurtis', path=None, procs=1,
+             block_size=BLOCK_SIZE):
+    """Distances between all rows of *table*, as a memory-mapped Distances.
+
+    *metric* is 'braycurtis', 'jaccard' (on presence/absence, like scipy's)
+    or 'euclidean'.  The condensed matrix is written to *path*, or to a
+    temporary file (removed once it's mapped) if that's None.
+
+    """
+    if metric not in METRICS:
+        raise ValueError("metric must be one of {}".format(METRICS))
+    values, index = _as_table(table)
+    n = values.shape[0]
+    size = n * (n - 1) // 2
+    if path is None:
+        handle, temp_path = tempfile.mkstemp(prefix='distances-',
+                                             suffix='.f8')
+        os.close(handle)
+    else:
+        temp_path = path
+    np.memmap(temp_path, dtype=float, mode='w+', shape=(max(size, 1),)).flush()
+
+    starts = list(range(0, n, block_size))
+    init_args = (values, temp_path, n, metric, block_size)
+    if procs > 1:
+        with multiprocessing.Pool(procs, initializer=_init_worker,
+                                  initargs=init_args) as pool:
+            pool.map(_compute_strip, starts)
+    else:
+        _init_worker(*init_args)
+        for start in starts:
+            _compute_strip(start)
+
+    condensed = np.memmap(temp_path, dtype=float, mode='r',
+                          shape=(max(size, 1),))[:size]
+    if path is None:
+        os.remove(temp_path)
+    return Distances(condensed, index, path=path)
+
+
+def open_distances(path, index):
+    """Map a condensed matrix written by `pairwise` for rows *index*."""
+    n = len(index)
+    size = n * (n - 1) // 2
+    condensed = np.memmap(path, dtype=float, mode='r',
+                          shape=(max(size, 1),))[:size]
+    return Distances(condensed, index, path=path)
+
+
+def pcoa(distances, dimensions=2):
+    """Principal coordinates analysis of a Distances.
+
+    The leading eigenvectors of the Gower-centered matrix are found with
+    Lanczos iterations over streamed rows (or, for small matrices, a dense
+    solver).  Returns an Ordination of *samples* (coordinates, with columns
+    PC1, PC2, ...), *eigvals* and *proportion_explained* (of the sum of all
+    eigenvalues, i.e. the trace).
+
+    """
+    n = len(distances)
+    if n <= max(DENSE_EIGEN_SIZE, dimensions + 1):
+        g = distances.gower_dot(np.eye(n))
+        eigvals, eigvecs = np.linalg.eigh(g)
+        order = np.argsort(eigvals)[::-1][:dimensions]
+    else:
+        operator = sparse_linalg.LinearOperator(
+                (n, n), matvec=distances.gower_dot,
+                matmat=distances.gower_dot, dtype=float)
+        eigvals, eigvecs = sparse_linalg.eigsh(operator, k=dimensions,
+                                               which='LA')
+        order = np.argsort(eigvals)[::-1]
+    eigvals, eigvecs = eigvals[order], eigvecs[:, order]
+    # Flip each axis so its largest loading is positive, for stable plots.
+    eigvecs *= np.sign(eigvecs[np.abs(eigvecs).argmax(axis=0),
+                               np.arange(eigvecs.shape[1])])
+    names = ['PC{}'.format(i + 1) for i in range(len(eigvals))]
+    samples = pd.DataFrame(eigvecs * np.sqrt(np.clip(eigvals, 0, None)),
+                           index=distances.index, columns=names)
+    trace = distances.gower_diagonal().sum()
+    return Ordination(samples=samples,
+                      eigvals=pd.Series(eigvals, index=names),
+                      proportion_explained=pd.Series(eigvals / trace,
+                                                     index=names))
+
+
+def betadisper(distances, groups):
+    """Multivariate dispersion of each group, and an ANOVA of it.
+
+    Like vegan's `betadisper(d, groups, type='centroid')` followed by
+    `anova()`: each sample's distance to its group centroid in principal
+    coordinate space (with the axes of negative eigenvalues subtracted) is
+    found directly from the Gower-centered matrix, and the groups'
+    distances are compared with a one-way ANOVA.
+
+    Returns (a Series of distances to centroids, an ANOVA table with 'df',
+    'sum_sq', 'mean_sq', 'F' and 'PR(>F)' for 'Groups' and 'Residuals').
+
+    """
+    groups = pd.Series(np.asarray(groups), index=distances.index)
+    members = matrix.indicator(groups, distances.index).to_frame()
+    h = members.values / members.values.sum(axis=0)  # n x groups, means
+    gh = distances.gower_dot(h)
+    code = members.values.argmax(axis=1)
+    n = np.arange(len(distances))
+    squared = (distances.gower_diagonal() - 2 * gh[n, code]
+               + (h.T @ gh)[code, code])
+    z = pd.Series(np.sqrt(np.abs(squared)), index=distances.index,
+                  name='distance')
+
+    k = members.shape[1]
+    means = z.groupby(groups).transform('mean')
+    ss_groups = ((means - z.mean()) ** 2).sum()
+    ss_resid = ((z - means) ** 2).sum()
+    df = np.array([k - 1, len(z) - k], dtype=float)
+    mean_sq = np.array([ss_groups, ss_resid]) / df
+    f = mean_sq[0] / mean_sq[1]
+    table = pd.DataFrame({'df': df, 'sum_sq': [ss_groups, ss_resid],
+                          'mean_sq': mean_sq,
+                          'F': [f, np.nan],
+                          'PR(>F)': [sp_stats.f.sf(f, *df), np.nan]},
+                         index=['Groups', 'Residuals'])
+    return z, table[['df', 'sum_sq', 'mean_sq', 'F', 'PR(>F)']]
@@ -0,0 +1,126 @@
+"""Per-stage timing and memory records for the pipeline scripts.
+
+Scripts mark their major steps with `stage`:
+
+    with instrument.stage('parse') as stage:
+        ...
+        stage.rows = len(data)
+
+If the PROFILE_LOG environment variable names a file, each stage appends one
+JSON line to it when it finishes: the wall and CPU seconds it took, the peak
+RSS during it, its row count (if set), how many stages it's nested within,
+and which run, make target and script it belongs to (from PROFILE_RUN,
+PROFILE_TARGET and sys.argv).  The Makefile sets all three when PROFILE_LOG
+is given, and summarize_profile.py turns a run's records into a per-target,
+per-stage profile.  Without PROFILE_LOG, stages do nothing but time
+themselves.
+
+On Linux, the peak RSS of each stage is measured by resetting the kernel's
+high-water mark when the stage starts; elsewhere it's the peak of the whole
+process so far.
+
+"""
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+
+LOG_VAR = 'PROFILE_LOG'
+RUN_VAR = 'PROFILE_RUN'
+TARGET_VAR = 'PROFILE_TARGET'
+
+CLEAR_REFS = '/proc/self/clear_refs'
+STATUS = '/proc/self/status'
+
+_active = []  # Stack of the stages in progress
+
+
+def _peak_rss_mib():
+    """Peak RSS since the last reset (or process start), in MiB."""
+    try:
+        with open(STATUS) as handle:
+            for line in handle:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def _reset_peak_rss():
+    try:
+        with open(CLEAR_REFS, 'w') as handle:
+            handle.write('5')
+    except OSError:
+        pass
+
+
+def record(**fields):
+    """Append *fields*, with the run, target and script, to the log."""
+    path = os.environ.get(LOG_VAR)
+    if not path:
+        return
+    fields = dict({'run': os.environ.get(RUN_VAR),
+                   'target': os.environ.get(TARGET_VAR),
+                   'script': os.path.basename(sys.argv[0]),
+                   'pid': os.getpid()},
+                  **fields)
+    # A single short append, so records from parallel jobs don't interleave.
+    with open(path, 'a') as handle:
+        handle.write(json.dumps(fields) + '\n')
+
+
+class Stage():
+    """A named, timed step of a script; use `stage` to make one."""
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.max_rss_mib = None
+
+    def __enter__(self):
+        self._enabled = bool(os.environ.get(LOG_VAR))
+        if self._enabled:
+            # The enclosing stage's peak so far, before the reset.
+            if _active:
+                _active[-1]._peak = max(_active[-1]._peak, _peak_rss_mib())
+            _reset_peak_rss()
+            self._peak = 0
+        _active.append(self)
+        self._started = datetime.datetime.now()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_seconds = time.perf_counter() - self._wall
+        self.cpu_seconds = time.process_time() - self._cpu
+        _active.pop()
+        depth = len(_active)
+        if not self._enabled:
+            return False
+        self.max_rss_mib = max(self._peak, _peak_rss_mib())
+        if _active:
+            _active[-1]._peak = max(_active[-1]._peak, self.max_rss_mib)
+        record(stage=self.name,
+               depth=depth,
+               started=self._started.isoformat(),
+               status='ok' if exc_type is None else exc_type.__name__,
+               wall_seconds=self.wall_seconds,
+               cpu_seconds=self.cpu_seconds,
+               max_rss_mib=self.max_rss_mib,
+               rows=self.rows)
+        return False
+
+    def add_rows(self, count):
+        self.rows = (self.rows or 0) + count
+
+
+def stage(name, rows=None):
+    """A context manager recording the stage *name*; see the module doc."""
+    return Stage(name, rows=rows)
@@ -0,0 +1,96 @@
+"""Sparse matrices with row and column labels.
+
+OTU tables are mostly zeros; a LabeledMatrix keeps them as a CSR matrix with
+pandas indexes for the rows and columns, so memory scales with the number of
+nonzero entries rather than mice x OTUs.
+
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class LabeledMatrix():
+    """A scipy.sparse CSR matrix with pandas row (*index*) and *columns* labels."""
+    def __init__(self, matrix, index, columns):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.index = pd.Index(index)
+        self.columns = pd.Index(columns)
+        assert self.matrix.shape == (len(self.index), len(self.columns))
+
+    @classmethod
+    def from_long(cls, rows, columns, values, index=None, column_index=None):
+        """Build from parallel arrays of row labels, column labels and values.
+
+        Rows and columns are sorted, unless *index* or *column_index* give the
+        labels (and their order) explicitly.
+
+        """
+        if index is None:
+            index = pd.Index(pd.unique(rows)).sort_values()
+        if column_index is None:
+            column_index = pd.Index(pd.unique(columns)).sort_values()
+        row_codes = index.get_indexer(rows)
+        col_codes = column_index.get_indexer(columns)
+        assert (row_codes >= 0).all() and (col_codes >= 0).all()
+        matrix = sparse.csr_matrix((np.asarray(values), (row_codes, col_codes)),
+                                   shape=(len(index), len(column_index)))
+        return cls(matrix, index, column_index)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def astype(self, dtype):
+        return LabeledMatrix(self.matrix.astype(dtype), self.index, self.columns)
+
+    def sum(self, axis='columns'):
+        if axis in (1, 'columns'):
+            return pd.Series(np.asarray(self.matrix.sum(axis=1)).ravel(),
+                             index=self.index)
+        else:
+            return pd.Series(np.asarray(self.matrix.sum(axis=0)).ravel(),
+                             index=self.columns)
+
+    def scale_rows(self, factors):
+        """Multiply each row by the matching element of *factors*."""
+        factors = np.asarray(factors, dtype=float)
+        return LabeledMatrix(sparse.diags(factors) @ self.matrix,
+                             self.index, self.columns)
+
+    def dot(self, other):
+        """Matrix product with another LabeledMatrix."""
+        assert self.columns.equals(other.index)
+        return LabeledMatrix(self.matrix @ other.matrix,
+                             self.index, other.columns)
+
+    def to_frame(self):
+        """Densify into a DataFrame."""
+        return pd.DataFrame(self.matrix.toarray(),
+                            index=self.index, columns=self.columns)
+
+    def __repr__(self):
+        return '<LabeledMatrix {}x{}, {} nonzero>'.format(*self.shape,
+                                                           self.nnz)
+
+
+def indicator(labels, index, dtype=float):
+    """Membership matrix from each item in *index* to its group in *labels*.
+
+    *labels* is a Series mapping items to groups; items missing from it (or
+    mapped to NaN) belong to no group.  Groups are sorted.
+
+    """
+    labels = labels.reindex(index)
+    groups = (pd.Index(labels.dropna().unique(), name=labels.name)
+                .sort_values())
+    codes = groups.get_indexer(labels)
+    member = np.flatnonzero(codes >= 0)
+    matrix = sparse.csr_matrix((np.ones(len(member), dtype=dtype),
+                                (member, codes[member])),
+                               shape=(len(index), len(groups)))
+    return LabeledMatrix(matrix, index, groups)
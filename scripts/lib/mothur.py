@@ -0,0 +1,168 @@
+"""Readers and writers for MOTHUR list (.otus) and names files.
+
+A list file has one row per clustering label (e.g. 'unique', '0.03'), each
+listing every OTU's comma-separated member sequences, so rows can be
+gigabytes long.  ListFile indexes the byte offset of each label row (and of
+the header row naming its OTUs) in one chunked scan, saves the index next to
+the list file, and then reads any set of labels by seeking straight to
+their rows.
+
+"""
+import collections
+import io
+import json
+import os
+import sys
+
+CHUNK_SIZE = 2**20
+BUFFER_SIZE = 2**22
+INDEX_SUFFIX = '.labels.json'
+
+
+def _scan_lines(handle):
+    """Yield (offset, first tab-separated field) for each line of *handle*.
+
+    The file is read in chunks, so long lines are never held in memory.
+
+    """
+    offset = 0  # Of the current chunk
+    start = 0  # Of the current line
+    field = b''
+    in_field = True
+    for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+        pos = 0
+        while pos < len(chunk):
+            if in_field:
+                ends = [i for i in (chunk.find(b'\t', pos),
+                                    chunk.find(b'\n', pos)) if i >= 0]
+                if not ends:
+                    field += chunk[pos:]
+                    break
+                field += chunk[pos:min(ends)]
+                yield start, field
+                field, in_field, pos = b'', False, min(ends)
+            else:
+                newline = chunk.find(b'\n', pos)
+                if newline < 0:
+                    break
+                pos = newline + 1
+                start, in_field = offset + pos, True
+        offset += len(chunk)
+    if in_field and field.strip():
+        yield start, field
+
+
+class ListFile():
+    """A MOTHUR list file, with an index of its label rows.
+
+    The index is saved as *path* + '.labels.json' (if that's writable) and
+    rebuilt whenever the list file changes.
+
+    """
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+        self.rows = self._load_index()
+        if self.rows is None:
+            self.rows = self._build_index()
+
+    @property
+    def labels(self):
+        return list(self.rows)
+
+    def _identity(self):
+        stat = os.stat(self.path)
+        return [stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime)]
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as handle:
+                index = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        if index.get('identity') != self._identity():
+            return None
+        return collections.OrderedDict((label, tuple(offsets))
+                                       for label, offsets in index['rows'])
+
+    def _build_index(self):
+        """Map each label to the offsets of its row and its header row."""
+        rows = collections.OrderedDict()
+        header = None
+        with open(self.path, 'rb') as handle:
+            for offset, label in _scan_lines(handle):
+                label = label.decode().strip()
+                if not label:
+                    continue
+                elif label == 'label':
+                    header = offset
+                else:
+                    rows[label] = (offset, header)
+        index = {'identity': self._identity(), 'rows': list(rows.items())}
+        temp_path = self.index_path + '.temp'
+        try:
+            with open(temp_path, 'w') as handle:
+                json.dump(index, handle)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            pass  # The index is only an optimization.
+        return rows
+
+    def read(self, labels):
+        """Yield (label, otu_names, member_lists) for each of *labels*.
+
+        Rows are read in file order, in one pass.
+
+        """
+        for label in labels:
+            if label not in self.rows:
+                raise AssertionError("The requested label, {}, was not found."
+                                     .format(label))
+        wanted = sorted(set(labels), key=lambda label: self.rows[label][0])
+        with open(self.path, 'rb') as handle:
+            names_offset, names = None, None
+            for label in wanted:
+                offset, header = self.rows[label]
+                if header is None:
+                    raise AssertionError("No header found for label {}."
+                                         .format(label))
+                if header != names_offset:
+                    handle.seek(header)
+                    names = handle.readline().decode().strip().split('\t')[2:]
+                    names_offset = header
+                handle.seek(offset)
+                groups = handle.readline().decode().strip().split('\t')[2:]
+                yield label, names, groups
+
+
+def iter_names(handle):
+    """Yield (name, member list) for each line of a names file."""
+    for line in handle:
+        name, members = line.split('\t')
+        yield name, members.strip().split(',')
+
+
+def open_output(path=None):
+    """A buffered text writer for *path*, or for stdout if it's None or '-'."""
+    if path is None or path == '-':
+        return io.open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE,
+                       closefd=False)
+    return io.open(path, 'w', buffering=BUFFER_SIZE)
+
+
+def write_names(handle, names, groups):
+    """Write a names file mapping each OTU to its members."""
+    handle.writelines(name + '\t' + group.strip() + '\n'
+                      for name, group in zip(names, groups))
+
+
+def write_taxonomy(handle, groups, taxon_level, taxon_level_b):
+    """Write each member of *groups* (name, members) as a taxonomy row.
+
+    Rows are taxon_id (the member), taxon_level, taxon_id_b (the group's
+    name), taxon_level_b and a confidence of 100.
+
+    """
+    for name, members in groups:
+        suffix = '\t'.join(['', taxon_level, name, taxon_level_b, '100\n'])
+        handle.writelines(member + suffix for member in members)
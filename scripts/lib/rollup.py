@@ -0,0 +1,92 @@
+"""Aggregate OTU tables to higher taxonomic ranks.
+
+A TaxonRollup stacks one sparse OTU->taxon membership matrix per rank side
+by side, so a single product sums an OTU table to every rank at once.  The
+membership is built once and reused for any number of tables (abundance,
+relative abundance, counts; dense DataFrames or matrix.LabeledMatrix).
+
+    rollup = TaxonRollup(d['taxonomy'], d['abund'].columns)
+    by_rank = rollup.aggregate(d['abund'], clip=True)
+    by_rank['family'], by_rank['genus']
+
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from . import matrix
+
+RANKS = ['phylum', 'class', 'order', 'family', 'genus']
+UNCLASSIFIED = 'unclassified'
+
+
+class TaxonRollup():
+    """OTU membership in each taxon, at every rank.
+
+    *taxonomy* is a frame of OTUs by rank, like `taxonomy` from load_data
+    (which only includes assignments with confidence > 0.7); OTUs without an
+    assignment at a rank are counted as unclassified there.  *otus* is the
+    column order of the tables to aggregate (default: the taxonomy's index).
+
+    """
+    def __init__(self, taxonomy, otus=None, ranks=RANKS):
+        self.ranks = list(ranks)
+        self.otus = pd.Index(taxonomy.index if otus is None else otus)
+        members = [matrix.indicator(taxonomy[rank], self.otus)
+                   for rank in self.ranks]
+        self.taxa = {rank: m.columns for rank, m in zip(self.ranks, members)}
+        self.members = sparse.hstack([m.matrix for m in members]).tocsr()
+        self._bounds = np.cumsum([0] + [m.shape[1] for m in members])
+        self._last = (self.otus, self.members)
+
+    def membership(self, columns):
+        """Stacked membership matrix with rows in the order of *columns*.
+
+        OTUs not in the rollup's own index belong to no taxon.
+
+        """
+        last_columns, last_members = self._last
+        if columns.equals(last_columns):
+            return last_members
+        codes = self.otus.get_indexer(columns)
+        present = np.flatnonzero(codes >= 0)
+        select = sparse.csr_matrix((np.ones(len(present)),
+                                    (present, codes[present])),
+                                   shape=(len(columns), len(self.otus)))
+        members = (select @ self.members).tocsr()
+        self._last = (columns, members)
+        return members
+
+    def aggregate(self, table, total=None, clip=False):
+        """Sum *table* (samples x OTUs) to every rank.
+
+        Returns {rank: DataFrame} with one column per taxon (sorted) and an
+        'unclassified' column: *total* (default: each row's sum) minus the
+        classified sum, floored at zero if *clip*.  Missing values count as
+        zero.
+
+        """
+        if isinstance(table, matrix.LabeledMatrix):
+            values, index, columns = table.matrix, table.index, table.columns
+        else:
+            values = table.fillna(0).values
+            index, columns = table.index, table.columns
+        members = self.membership(columns).astype(values.dtype)
+        if sparse.issparse(values):
+            summed = (values @ members).toarray()
+        else:
+            summed = np.asarray(members.T @ values.T).T
+        if total is None:
+            total = np.asarray(values.sum(axis=1)).ravel()
+        total = np.asarray(total)
+
+        out = {}
+        for rank, start, stop in zip(self.ranks, self._bounds[:-1],
+                                     self._bounds[1:]):
+            frame = pd.DataFrame(summed[:, start:stop], index=index,
+                                 columns=self.taxa[rank])
+            unclassified = total - summed[:, start:stop].sum(axis=1)
+            if clip:
+                unclassified = np.maximum(unclassified, 0)
+            frame[UNCLASSIFIED] = unclassified
+            out[rank] = frame
+        return out
@@ -1,6 +1,25 @@
+import multiprocessing
+import warnings
 import patsy
 import scipy as sp
+import scipy.sparse
+import scipy.spatial.distance
+import scipy.stats
 import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from . import matrix
+
+PERMUTATION_BLOCK_SIZE = 1000
+SCREEN_BLOCK_SIZE = 50  # features per task
+SCREEN_COLS = [ 'coef'
+              , 'se'
+              , 'hazard_ratio'
+              , 'pvalue'
+              , 'aic'
+              , 'delta_aic'
+              , 'lrt_pvalue'
+              ]
 
 class RaiseLowTransform():
     """Replace unmeasured values with a fraction of the smallest measured value.
@@ -42,3 +61,377 @@ def lrt_phreg(fit1, fit0):
     delta_params = fit1.df_model - fit0.df_model
     delta_llf = fit1.llf - fit0.llf
     return 1 - sp.stats.chi2(df=delta_params).cdf(2 * delta_llf)
+
+def _square_distances(distances):
+    """A square ndarray from a square or condensed distance matrix."""
+    if isinstance(distances, pd.DataFrame):
+        distances = distances.values
+    distances = np.asarray(getattr(distances, 'data', distances), dtype=float)
+    if distances.ndim == 1:
+        distances = sp.spatial.distance.squareform(distances, checks=False)
+    return distances
+
+def gower_center(distances):
+    """Gower's centered matrix, -(1/2) C D**2 C, of a distance matrix."""
+    g = -0.5 * _square_distances(distances) ** 2
+    g -= g.mean(axis=0, keepdims=True)
+    g -= g.mean(axis=1, keepdims=True)
+    return g
+
+def sequential_basis(design, tol=1e-10):
+    """Orthonormal columns spanning each term of *design* in turn.
+
+    *design* is a patsy DesignMatrix.  Each term's columns are projected
+    off the span of the terms before it, so dependent columns (e.g. empty
+    cells of an interaction) add nothing.  Returns the basis and a list of
+    (term name, number of basis columns).
+
+    """
+    x = np.asarray(design, dtype=float)
+    scale = np.linalg.norm(x, axis=0).max()
+    basis = np.empty((x.shape[0], 0))
+    terms = []
+    for term, columns in design.design_info.term_slices.items():
+        part = x[:, columns]
+        part = part - basis @ (basis.T @ part)
+        u, s, _ = np.linalg.svd(part, full_matrices=False)
+        u = u[:, s > tol * scale]
+        basis = np.hstack([basis, u])
+        terms.append((term.name(), u.shape[1]))
+    return basis, terms
+
+def _sequential_ss(g, basis, permutations):
+    """Cumulative model sums of squares for each row of *permutations*.
+
+    Each permutation reorders the observations (rows of the basis), so
+    the model SS of its first k columns is the sum of q_j' G q_j over them.
+    Returns a (permutations x basis columns) array.
+
+    """
+    permuted = basis[permutations]  # permutations x n x p
+    return np.cumsum((permuted * np.matmul(g, permuted)).sum(axis=1), axis=1)
+
+_PERMANOVA = {}
+
+def _init_permanova(g, basis, ends, df_terms, df_resid, observed_f, seed):
+    _PERMANOVA.update(g=g, basis=basis, ends=ends, df_terms=df_terms,
+                      df_resid=df_resid, observed_f=observed_f, seed=seed)
+
+def _permanova_block(args):
+    """Count permutations in one block with F at least that observed."""
+    block, size = args
+    state = _PERMANOVA
+    rng = np.random.RandomState([state['seed'], block])
+    n = state['g'].shape[0]
+    permutations = np.argsort(rng.random_sample((size, n)), axis=1)
+    cumulative = _sequential_ss(state['g'], state['basis'], permutations)
+    model_ss = cumulative[:, state['ends']]
+    term_ss = np.diff(np.hstack([np.zeros((size, 1)), model_ss]), axis=1)
+    resid_ss = np.trace(state['g']) - model_ss[:, -1]
+    f = ((term_ss / state['df_terms'])
+         / (resid_ss[:, None] / state['df_resid']))
+    # Allow for rounding error in ties with the observed statistic.
+    return (f >= state['observed_f'] * (1 - 1e-7)).sum(axis=0)
+
+def permanova(distances, formula, data, permutations=999, seed=0,
+              procs=1, block_size=PERMUTATION_BLOCK_SIZE):
+    """Permutational MANOVA on a distance matrix with sequential terms.
+
+    Like vegan's `adonis2(d ~ formula, data, by='terms')`: each term's sum
+    of squares is what it adds to the terms before it in *formula* (e.g.
+    'treatment * site * sex'; any left-hand side is ignored).  *distances*
+    is a square or condensed distance matrix in the order of *data*'s rows
+    (or, as a DataFrame or a distance.Distances, labeled with *data*'s
+    index).
+
+    Observations are permuted freely, *block_size* permutations at a time
+    as one batch of matrix products; blocks are spread over *procs*
+    processes.  Block i draws its permutations from the seed (*seed*, i),
+    so results depend only on *seed*, not *procs*.
+
+    Returns a table with 'df', 'sum_sq', 'rsquared', 'F' and 'PR(>F)' for
+    each term, the residual and the total.
+
+    """
+    if hasattr(distances, 'index'):
+        data = data.loc[distances.index]
+    g = gower_center(distances)
+    assert g.shape == (len(data), len(data))
+    design = patsy.dmatrix(formula.split('~')[-1], data, NA_action='raise')
+    basis, terms = sequential_basis(design)
+    names = [name for name, _ in terms]
+    df_terms = np.array([df for _, df in terms], dtype=float)
+    ends = np.cumsum(df_terms).astype(int) - 1
+
+    # Terms that add no columns (like the intercept) aren't tested.
+    tested = df_terms > 0
+    if names and names[0] == 'Intercept':
+        tested[0] = False
+    names = [name for name, test in zip(names, tested) if test]
+    ends, df_terms = ends[tested], df_terms[tested]
+
+    total_ss = np.trace(g)
+    df_resid = len(data) - basis.shape[1]
+    identity = np.arange(len(data))[None, :]
+    model_ss = _sequential_ss(g, basis, identity)[0, ends]
+    term_ss = np.diff(np.concatenate([[0], model_ss]))
+    resid_ss = total_ss - model_ss[-1]
+    observed_f = (term_ss / df_terms) / (resid_ss / df_resid)
+
+    blocks = [(i, min(block_size, permutations - start))
+              for i, start in enumerate(range(0, permutations, block_size))]
+    init_args = (g, basis, ends, df_terms, df_resid, observed_f, seed)
+    if procs > 1:
+        with multiprocessing.Pool(procs, initializer=_init_permanova,
+                                  initargs=init_args) as pool:
+            counts = pool.map(_permanova_block, blocks)
+    else:
+        _init_permanova(*init_args)
+        counts = [_permanova_block(block) for block in blocks]
+    exceed = np.sum(counts, axis=0) if counts else np.zeros(len(names))
+    p = (exceed + 1) / (permutations + 1)
+
+    out = pd.DataFrame({'df': np.concatenate([df_terms,
+                                              [df_resid, len(data) - 1]]),
+                        'sum_sq': np.concatenate([term_ss,
+                                                  [resid_ss, total_ss]]),
+                        'F': np.concatenate([observed_f, [np.nan, np.nan]]),
+                        'PR(>F)': np.concatenate([p, [np.nan, np.nan]])},
+                       index=names + ['Residual', 'Total'])
+    out['rsquared'] = out.sum_sq / total_ss
+    return out[['df', 'sum_sq', 'rsquared', 'F', 'PR(>F)']]
+
+_SCREEN = {}
+
+def _fit_phreg(exog, start_params=None):
+    state = _SCREEN
+    model = sm.PHReg(state['duration'], exog, status=state['status'],
+                     entry=state['entry'], ties=state['ties'])
+    return model.fit(start_params=start_params)
+
+def _init_screen(duration, status, entry, base, ties, standardize):
+    _SCREEN.update(duration=duration, status=status, entry=entry, base=base,
+                   ties=ties, standardize=standardize)
+    _SCREEN['fit0'] = _fit_phreg(base)
+
+def _screen_block(args):
+    """Fit the base model plus each column of a block of features, in turn."""
+    names, values = args
+    state = _SCREEN
+    fit0, base = state['fit0'], state['base']
+    # The feature's coefficient starts at 0, the rest at the base model's.
+    start = np.concatenate([[0], fit0.params])
+    out = []
+    for name, x in zip(names, values.T):
+        sd = x.std(ddof=1)
+        if not sd > 0:
+            out.append((name, [np.nan] * len(SCREEN_COLS)))
+            continue
+        if state['standardize']:
+            x = (x - x.mean()) / sd
+        try:
+            fit1 = _fit_phreg(np.column_stack([x, base]), start_params=start)
+        except np.linalg.LinAlgError:
+            out.append((name, [np.nan] * len(SCREEN_COLS)))
+            continue
+        coef, se = fit1.params[0], fit1.bse[0]
+        out.append((name, [coef, se, np.exp(coef), fit1.pvalues[0],
+                           phreg_aic(fit1), phreg_aic(fit1) - phreg_aic(fit0),
+                           lrt_phreg(fit1, fit0)]))
+    return out
+
+def _feature_matrix(features, index):
+    """(Column names, sparse CSC matrix of the rows of *index*) of features.
+
+    *features* is a DataFrame or a matrix.LabeledMatrix.
+
+    """
+    if isinstance(features, matrix.LabeledMatrix):
+        rows = features.index.get_indexer(index)
+        if (rows < 0).any():
+            raise ValueError("features are missing rows of data")
+        values = features.matrix.tocsr()[rows].tocsc()
+    else:
+        values = features.reindex(index)
+        missing = values.columns[values.isnull().any().values]
+        if len(missing):
+            raise ValueError("features have missing values for rows of data "
+                             "in: {}".format(', '.join(map(str, missing))))
+        values = sp.sparse.csc_matrix(values.values.astype(float))
+    values.eliminate_zeros()
+    return pd.Index(features.columns), values
+
+def _rows_in_features(data, features):
+    """The rows of *data* that are in *features*, warning if any aren't."""
+    present = data.index.isin(features.index)
+    if not present.all():
+        warnings.warn("{} of {} rows of data aren't in features; "
+                      "leaving them out.".format((~present).sum(), len(data)))
+        data = data[present]
+    return data
+
+def _feature_blocks(features, index, block_size):
+    """Yield (column names, dense rows-of-*index* x columns) blocks."""
+    columns, values = _feature_matrix(features, index)
+    for start in range(0, values.shape[1], block_size):
+        stop = start + block_size
+        yield list(columns[start:stop]), values[:, start:stop].toarray()
+
+def phreg_screen(features, data, formula='treatment * sex * site',
+                 duration='age_at_death_or_censor', status='dead',
+                 entry='age_at_collect', standardize=True, ties='efron',
+                 procs=1, block_size=SCREEN_BLOCK_SIZE):
+    """Screen features one at a time as covariates of a Cox model.
+
+    For each column of *features* (e.g. `conc`, `rabund` or
+    `rabund_family`; a DataFrame or a matrix.LabeledMatrix, indexed like
+    *data*), fits the left-truncated proportional hazards model
+    `x + formula`, like R's
+
+        coxph(Surv(entry, duration, status) ~ stnd(x) + treatment * sex * site)
+
+    and compares it to the base model without x.  The base design matrix
+    is built once from *data*, and blocks of *block_size* features are
+    fit across *procs* processes.  With *standardize*, x is centered and
+    scaled by its standard deviation, as with stnd().
+
+    Returns a table, indexed by feature, of the coefficient of x, its
+    standard error, hazard ratio and Wald p-value, the model's AIC and its
+    difference from the base model's, and the p-value of a likelihood
+    ratio test against the base model.  Features that are constant over
+    *data*, or whose model can't be fit, are NaN.
+
+    Rows of *data* missing from *features* (e.g. mice without
+    concentrations) are left out, with a warning.
+
+    """
+    data = data.dropna(subset=[duration, status, entry])
+    data = _rows_in_features(data, features)
+    base = patsy.dmatrix(formula.split('~')[-1], data, NA_action='raise',
+                         return_type='dataframe')
+    # PHReg has no intercept; the baseline hazard absorbs it.
+    base = base.drop('Intercept', axis='columns', errors='ignore').values
+    init_args = (data[duration].values.astype(float),
+                 data[status].values.astype(float),
+                 data[entry].values.astype(float),
+                 base, ties, standardize)
+    blocks = _feature_blocks(features, data.index, block_size)
+    if procs > 1:
+        with multiprocessing.Pool(procs, initializer=_init_screen,
+                                  initargs=init_args) as pool:
+            results = list(pool.imap(_screen_block, blocks))
+    else:
+        _init_screen(*init_args)
+        results = [_screen_block(block) for block in blocks]
+    rows = [row for result in results for row in result]
+    out = pd.DataFrame([values for _, values in rows],
+                       index=pd.Index([name for name, _ in rows],
+                                      name='feature'),
+                       columns=SCREEN_COLS)
+    return out
+
+def benjamini_hochberg(pvalues):
+    """Benjamini-Hochberg q-values; NaN p-values are left out (and NaN)."""
+    p = np.asarray(pvalues, dtype=float)
+    q = np.full(p.shape, np.nan)
+    tested = np.flatnonzero(~np.isnan(p))
+    order = tested[np.argsort(p[tested], kind='mergesort')]
+    scaled = p[order] * len(order) / np.arange(1, len(order) + 1)
+    q[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1)
+    if isinstance(pvalues, pd.Series):
+        return pd.Series(q, index=pvalues.index, name=pvalues.name)
+    return q
+
+def _rank_sums(values, in_first):
+    """Rank sums of the first group, and tie terms, for each column.
+
+    Ranks within each column of the CSC matrix *values* are found in one
+    sort of its stored (nonzero) entries, with each column's zeros added
+    as a single tied entry.  Returns (rank sum of the rows *in_first*,
+    sum of t**3 - t over each column's groups of t tied values).
+
+    """
+    n, m = values.shape
+    stored = np.diff(values.indptr)
+    col = np.repeat(np.arange(m), stored)
+    zeros = n - stored
+    zero_col = np.flatnonzero(zeros)
+    cols = np.concatenate([col, zero_col])
+    vals = np.concatenate([values.data, np.zeros(len(zero_col))])
+    weight = np.concatenate([np.ones(len(col)), zeros[zero_col]])
+
+    order = np.lexsort((vals, cols))
+    cols, vals, weight = cols[order], vals[order], weight[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (cols[1:] != cols[:-1]) | (vals[1:] != vals[:-1])
+    group = np.cumsum(starts) - 1
+    ties = np.bincount(group, weights=weight)
+    group_col = cols[starts]
+    # Every column has n values in all, so earlier columns take n ranks each.
+    before = np.cumsum(ties) - ties - group_col * n
+    rank = np.empty(len(order))
+    rank[order] = (before + (ties + 1) / 2)[group]
+
+    first = in_first[values.indices]
+    rank_sum = np.bincount(col[first], weights=rank[:len(col)][first],
+                           minlength=m)
+    first_zeros = in_first.sum() - np.bincount(col[first], minlength=m)
+    rank_sum[zero_col] += first_zeros[zero_col] * rank[len(col):]
+    tie_term = np.bincount(group_col, weights=ties ** 3 - ties, minlength=m)
+    return rank_sum, tie_term
+
+def mannwhitneyu_screen(features, data, groups, levels=None,
+                        alternative='two-sided', use_continuity=True):
+    """Mann-Whitney U tests between two groups for every feature at once.
+
+    *groups* is a column of *data* with two levels (rows where it's NaN
+    are left out), and *features* a DataFrame or matrix.LabeledMatrix
+    (e.g. `rabund` loaded with sparse=True) indexed like *data*.  The
+    first of *levels* (by default, in order of appearance) is compared to
+    the second.  Sparse features are ranked without densifying them.
+    Rows of *data* missing from *features* are left out, with a warning.
+
+    P-values are from the normal approximation with tie correction, as
+    with scipy.stats.mannwhitneyu(method='asymptotic'); *alternative*
+    'greater' means the first level tends to be greater.  Constant
+    features get NaN p-values.
+
+    Returns a table, indexed by feature, of U (for the first level),
+    'pvalue' and Benjamini-Hochberg 'qvalue' (over the features tested).
+
+    """
+    data = _rows_in_features(data.dropna(subset=[groups]), features)
+    if levels is None:
+        levels = data[groups].unique()
+    assert len(levels) == 2
+    data = data[data[groups].isin(levels)]
+    columns, values = _feature_matrix(features, data.index)
+    in_first = (data[groups] == levels[0]).values
+    n1 = in_first.sum()
+    n2 = len(in_first) - n1
+    n = n1 + n2
+
+    rank_sum, tie_term = _rank_sums(values, in_first)
+    u1 = rank_sum - n1 * (n1 + 1) / 2
+    mu = n1 * n2 / 2
+    sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    if alternative == 'two-sided':
+        u = np.maximum(u1, n1 * n2 - u1)
+    elif alternative == 'greater':
+        u = u1
+    elif alternative == 'less':
+        u = n1 * n2 - u1
+    else:
+        raise ValueError("alternative must be 'two-sided', 'less' or "
+                         "'greater'")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (u - mu - (0.5 if use_continuity else 0)) / sigma
+    z[sigma == 0] = np.nan
+    p = sp.stats.norm.sf(z)
+    if alternative == 'two-sided':
+        p = np.minimum(2 * p, 1)
+
+    out = pd.DataFrame({'U': u1, 'pvalue': p},
+                       index=pd.Index(columns, name='feature'))
+    out['qvalue'] = benjamini_hochberg(out.pvalue)
+    return out[['U', 'pvalue', 'qvalue']]
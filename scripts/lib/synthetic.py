@@ -0,0 +1,336 @@
+"""Synthetic pipeline inputs, for benchmarking at scale.
+
+Inputs are generated at a *scale* relative to the data in this repository.
+Metadata is replicated *scale* times (the first copy keeps the original IDs;
+later copies add a '~<n>' suffix to every mouse, sample, extraction,
+injection, calibration group and library ID), so there are *scale* times as
+many libraries and injections.  Count tables and shared files have a fixed
+number of features, N_SEQS and N_OTUS, across all libraries.  Taxonomy files
+and alignments (one row per feature) have *scale* times N_OTUS or N_SEQS
+rows.
+
+Everything is written in blocks of rows, so inputs much larger than memory
+can be generated.  The same *seed* always gives the same files.
+
+"""
+import collections
+import io
+import os
+import numpy as np
+import pandas as pd
+
+META_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'meta')
+BUFFER_SIZE = 2**22
+BLOCK_ROWS = 2000
+
+N_SEQS = 20000  # Unique sequences in a count table (and alignment, at 1x)
+N_OTUS = 2000  # OTUs in a shared file (and taxonomy, at 1x)
+ALIGNMENT_LENGTH = 5000
+ALIGNED_FRACTION = 0.1  # of alignment columns with any bases
+SEQ_DEPTH = 20000  # Mean reads per library
+MISSING_PEAK_FRACTION = 0.3
+EXPORT_SIZE = 100  # injections per LC Solutions export
+TAXON_LEVELS = ['domain', 'phylum', 'class', 'order', 'family', 'genus']
+
+# Metadata tables (and their files under META_DIR), with the ID columns
+# that are made distinct in each replicate.
+METADATA = collections.OrderedDict([
+  ('mouse', ('mouse.tsv', ['mouse_id']))
+, ('sample', ('sample.tsv', ['sample_id', 'mouse_id']))
+, ('extraction', ('extraction.tsv', ['extraction_id', 'sample_id']))
+, ('molecule', ('hplc/molecule.tsv', []))
+, ('standard', ('hplc/standard.tsv', []))
+, ('known', ('hplc/known.tsv', []))
+, ('injection', ('hplc/injection.tsv', ['injection_id', 'extraction_id']))
+, ('calibration_group', ('hplc/calibration_group.tsv',
+                         ['injection_id', 'calibration_group']))
+, ('calibration_config', ('hplc/calibration_config.tsv', []))
+, ('primer', ('rrs/primer.tsv', []))
+, ('spike', ('spike.tsv', []))
+, ('rrs_library', ('rrs/library.tsv', ['rrs_library_id', 'extraction_id']))
+, ('rrs_analysis_group', ('rrs/analysis_group.tsv', ['rrs_library_id']))
+])
+
+# Header of each table in an LC Solutions export, and the columns filled in.
+LCS_HEADER = ['', 'Data Filename', 'Sample Name', 'Sample ID', 'Sample Type',
+              'Level', 'Ret. Time', 'Area', 'Height', 'ISTD Area',
+              'ISTD Height', 'Area Ratio', 'Height Ratio', 'Conc.',
+              'Std. Conc.', 'Deviation', '%Dev', 'Accuracy',
+              'QC Check Results', 'Mark', 'Peak Start', 'Peak End',
+              'T.Plate#', 'HETP', 'meter', 'Tailing F.', 'Tailing F(10%)',
+              'Resolution', "k'", 'Separation F.', 'Area%', 'Height%',
+              'USP Width', 'Width(5%)', 'Width(10%)', 'Width(50%)',
+              'Relative Retention Time', 'Statistic']
+LCS_MISSING = '-----'
+
+
+def _output(path):
+    return io.open(path, 'w', buffering=BUFFER_SIZE)
+
+
+def replicate_id(values, replicate):
+    if replicate == 0:
+        return values
+    return values.where(values.isnull(),
+                        values.astype(str) + '~{}'.format(replicate))
+
+
+def replicate_metadata(scale, meta_dir=META_DIR):
+    """The metadata tables, with ID columns replicated *scale* times."""
+    tables = collections.OrderedDict()
+    for table, (path, id_cols) in METADATA.items():
+        data = pd.read_table(os.path.join(meta_dir, path), dtype=str)
+        if id_cols:
+            copies = []
+            for replicate in range(scale):
+                copy = data.copy()
+                for col in id_cols:
+                    copy[col] = replicate_id(copy[col], replicate)
+                copies.append(copy)
+            data = pd.concat(copies, ignore_index=True)
+        tables[table] = data
+    return tables
+
+
+def write_metadata(tables, outdir):
+    """Write each metadata table to *outdir*; returns {table: path}."""
+    paths = collections.OrderedDict()
+    for table, data in tables.items():
+        paths[table] = os.path.join(outdir, table + '.tsv')
+        data.to_csv(paths[table], sep='\t', index=False)
+    return paths
+
+
+def _standard_concentrations(tables):
+    """Concentration of each molecule in each known injection."""
+    known = tables['known'].assign(dilution=lambda d: d.dilution.astype(float))
+    standard = tables['standard'].assign(
+            concentration=lambda d: d.concentration.astype(float))
+    conc = known.merge(standard, on='standard_id')
+    conc['concentration'] *= conc.dilution
+    return conc.set_index(['known_id', 'molecule_id']).concentration
+
+
+def _peaks(injection, molecules, concentration, rng):
+    """Simulated peak measurements for every injection and molecule."""
+    n_inj, n_mol = len(injection), len(molecules)
+    slope = rng.normal(13.5, 0.1, size=(n_inj, 1))
+    intercept = rng.normal(0.5, 0.05, size=(n_inj, 1))
+    retention = molecules.retention_constant.values[None, :]
+    tip = retention * slope + intercept + rng.normal(0, 0.03, (n_inj, n_mol))
+
+    area = rng.lognormal(10, 1.5, size=(n_inj, n_mol))
+    known = concentration.reindex(pd.MultiIndex.from_product(
+            [injection.known_id.values, molecules.index])).values
+    known = known.reshape(n_inj, n_mol)
+    response = rng.lognormal(np.log(5e4), 0.3, size=(1, n_mol))
+    is_known = ~np.isnan(known)
+    area[is_known] = (known * response
+                      * rng.lognormal(0, 0.03, (n_inj, n_mol)))[is_known]
+
+    width_50 = rng.lognormal(np.log(0.35), 0.25, size=(n_inj, n_mol))
+    missing = ((rng.random_sample((n_inj, n_mol)) < MISSING_PEAK_FRACTION)
+               | np.isnan(retention) | (is_known & (known == 0)))
+    return dict(tip=tip, area=area, height=area / (width_50 * 64),
+                left=tip - 1.2 * width_50, right=tip + 1.6 * width_50,
+                width_05=2.2 * width_50, width_10=1.8 * width_50,
+                width_50=width_50, missing=missing)
+
+
+def write_lcs_exports(tables, outdir, channel='RI', seed=0):
+    """Write LC Solutions exports of simulated peaks for every injection.
+
+    Injections are split into exports of EXPORT_SIZE, with one table per
+    molecule, in the format parsed by parse_lcs_export.py.  Returns a list
+    of paths.
+
+    """
+    rng = np.random.RandomState(seed)
+    molecules = tables['molecule'].set_index('molecule_id')
+    molecules['retention_constant'] = \
+        molecules.retention_constant.astype(float)
+    concentration = _standard_concentrations(tables)
+    injection = tables['injection']
+    columns = {'Ret. Time': 'tip', 'Area': 'area', 'Height': 'height',
+               'Peak Start': 'left', 'Peak End': 'right',
+               'Width(5%)': 'width_05', 'Width(10%)': 'width_10',
+               'Width(50%)': 'width_50'}
+    paths = []
+    for number, start in enumerate(range(0, len(injection), EXPORT_SIZE)):
+        batch = injection.iloc[start:start + EXPORT_SIZE]
+        peaks = _peaks(batch, molecules, concentration, rng)
+        path = os.path.join(outdir, 'synthetic_{:04d}.{}.lcs_export.txt'
+                                    .format(number, channel))
+        with _output(path) as handle:
+            for j, molecule_id in enumerate(molecules.index):
+                handle.write('ID#\t{}\r\nName\t{}\r\n'
+                             .format(j + 1, molecule_id))
+                handle.write('\t'.join(LCS_HEADER) + '\r\n')
+                for i, injection_id in enumerate(batch.injection_id):
+                    row = {'': str(i + 1), 'Data Filename': injection_id,
+                           'Sample ID': 'SYN-{:03d}'.format(i + 1),
+                           'Sample Type': 'Unknown'}
+                    for col, key in columns.items():
+                        if peaks['missing'][i, j]:
+                            row[col] = LCS_MISSING
+                        else:
+                            row[col] = '{:.3f}'.format(peaks[key][i, j])
+                    handle.write('\t'.join(row.get(col, LCS_MISSING)
+                                           for col in LCS_HEADER) + '\r\n')
+                handle.write('\r\n')
+        paths.append(path)
+    return paths
+
+
+def _abundance(n, rng):
+    """Relative abundances for *n* features, with a long tail."""
+    weight = rng.lognormal(0, 2, size=n)
+    return weight / weight.sum()
+
+
+def _tallies(abundance, depth, rng):
+    """Poisson tallies for each feature (rows) in each library (columns)."""
+    return rng.poisson(abundance[:, None] * depth[None, :])
+
+
+def write_count_table(path, library_ids, n_seqs=N_SEQS, seed=0):
+    """Write a MOTHUR count table of *n_seqs* sequences."""
+    rng = np.random.RandomState(seed)
+    abundance = _abundance(n_seqs, rng)
+    depth = rng.lognormal(np.log(SEQ_DEPTH), 0.5, size=len(library_ids))
+    with _output(path) as handle:
+        handle.write('\t'.join(['Representative_Sequence', 'total']
+                               + list(library_ids)) + '\n')
+        for start in range(0, n_seqs, BLOCK_ROWS):
+            block = _tallies(abundance[start:start + BLOCK_ROWS], depth, rng)
+            for i, row in enumerate(block):
+                handle.write('Seq{:08d}\t{}\t'.format(start + i + 1, row.sum()))
+                handle.write('\t'.join(map(str, row)) + '\n')
+
+
+def otu_names(n):
+    return ['Otu{:06d}'.format(i + 1) for i in range(n)]
+
+
+def write_shared(path, library_ids, n_otus=N_OTUS, spike_otus=0,
+                 label='0.03', seed=0):
+    """Write a MOTHUR shared file of *n_otus* OTUs.
+
+    The last *spike_otus* OTUs get a tally in every library, like the spiked
+    in strains.
+
+    """
+    rng = np.random.RandomState(seed)
+    abundance = _abundance(n_otus, rng)
+    depth = rng.lognormal(np.log(SEQ_DEPTH), 0.5, size=len(library_ids))
+    with _output(path) as handle:
+        handle.write('\t'.join(['label', 'Group', 'numOtus']
+                               + otu_names(n_otus)) + '\n')
+        for start in range(0, len(library_ids), BLOCK_ROWS):
+            ids = library_ids[start:start + BLOCK_ROWS]
+            block = _tallies(abundance, depth[start:start + BLOCK_ROWS], rng).T
+            if spike_otus:
+                block[:, -spike_otus:] = rng.randint(50, 500,
+                                                     (len(ids), spike_otus))
+            for library_id, row in zip(ids, block):
+                handle.write('{}\t{}\t{}\t'.format(label, library_id, n_otus))
+                handle.write('\t'.join(map(str, row)) + '\n')
+
+
+def write_taxonomy(path, n_otus=N_OTUS, seed=0):
+    """Write a MOTHUR (consensus) taxonomy file of *n_otus* OTUs."""
+    rng = np.random.RandomState(seed)
+    # Each level has a few times more taxa than the one above it, and each
+    # genus determines its higher ranks.
+    n_taxa = [1, 12, 30, 60, 150, 600]
+    with _output(path) as handle:
+        handle.write('OTU\tSize\tTaxonomy\n')
+        for start in range(0, n_otus, BLOCK_ROWS):
+            size = min(BLOCK_ROWS, n_otus - start)
+            names = otu_names(start + size)[start:]
+            genus = rng.randint(0, n_taxa[-1], size)
+            taxa = np.stack([genus * n // n_taxa[-1] for n in n_taxa], axis=1)
+            confidence = np.minimum(100, rng.randint(60, 130, (size, 6)))
+            confidence[:, 0] = 100
+            # Classifications stop at the first confidence below 80.
+            unclassified = np.cumsum(confidence < 80, axis=1) > 0
+            for i, name in enumerate(names):
+                ranks = []
+                for j, level in enumerate(TAXON_LEVELS):
+                    if unclassified[i, j]:
+                        parent = ranks[-1].split('(')[0].replace(
+                                '_unclassified', '')
+                        taxon = parent + '_unclassified'
+                        ranks.append('{}({})'.format(taxon, 100))
+                    else:
+                        ranks.append('{}_{}({})'.format(
+                                level, taxa[i, j], confidence[i, j]))
+                handle.write('{}\t{}\t{};\n'.format(
+                        name, rng.randint(1, 1000), ';'.join(ranks)))
+
+
+def write_spike_hits(path, spike, n_otus=N_OTUS, label='0.03'):
+    """Assign each spike strain to one of the last OTUs of the shared file."""
+    strains = sorted(spike.spike_seq_id.unique())
+    otus = otu_names(n_otus)[-len(strains):]
+    pd.DataFrame({'taxon_id': otus,
+                  'taxon_level': 'otu-{}'.format(label),
+                  'spike_seq_id': strains},
+                 columns=['taxon_id', 'taxon_level', 'spike_seq_id']
+                 ).to_csv(path, sep='\t', index=False)
+    return len(strains)
+
+
+def write_alignment(path, n_seqs=N_SEQS, length=ALIGNMENT_LENGTH, seed=0):
+    """Write an aligned FASTA file of *n_seqs* sequences.
+
+    Only ALIGNED_FRACTION of the columns have any bases; the rest are all
+    gaps ('.' at the ends of a sequence, '-' inside it), as in a reference
+    alignment.
+
+    """
+    rng = np.random.RandomState(seed)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    aligned = np.sort(rng.choice(length, max(1, int(length * ALIGNED_FRACTION)),
+                                 replace=False))
+    with io.open(path, 'wb', buffering=BUFFER_SIZE) as handle:
+        for start in range(0, n_seqs, BLOCK_ROWS):
+            size = min(BLOCK_ROWS, n_seqs - start)
+            block = np.full((size, length), ord('-'), dtype=np.uint8)
+            block[:, :aligned[0]] = ord('.')
+            block[:, aligned[-1] + 1:] = ord('.')
+            filled = bases[rng.randint(0, 4, (size, len(aligned)))]
+            filled[rng.random_sample(filled.shape) < 0.05] = ord('-')
+            block[:, aligned] = filled
+            for i, row in enumerate(block):
+                handle.write('>Seq{:08d}\n'.format(start + i + 1).encode())
+                handle.write(row.tobytes() + b'\n')
+
+
+def generate(outdir, scale=1, seed=0):
+    """Write a full set of synthetic inputs at *scale* to *outdir*.
+
+    Returns a dict of paths: 'metadata' ({table: path}), 'exports' (a
+    list), 'count_table', 'shared', 'taxonomy', 'spike_hits' and
+    'alignment'.
+
+    """
+    os.makedirs(outdir, exist_ok=True)
+    tables = replicate_metadata(scale)
+    library_ids = list(tables['rrs_library'].rrs_library_id)
+    paths = {'metadata': write_metadata(tables, outdir)}
+    export_dir = os.path.join(outdir, 'exports')
+    os.makedirs(export_dir, exist_ok=True)
+    paths['exports'] = write_lcs_exports(tables, export_dir, seed=seed)
+
+    paths['count_table'] = os.path.join(outdir, 'synthetic.count_table')
+    write_count_table(paths['count_table'], library_ids, seed=seed)
+    paths['spike_hits'] = os.path.join(outdir, 'spike_hits.tsv')
+    n_spikes = write_spike_hits(paths['spike_hits'], tables['spike'])
+    paths['shared'] = os.path.join(outdir, 'synthetic.shared')
+    write_shared(paths['shared'], library_ids, spike_otus=n_spikes, seed=seed)
+    paths['taxonomy'] = os.path.join(outdir, 'synthetic.taxonomy')
+    write_taxonomy(paths['taxonomy'], N_OTUS * scale, seed=seed)
+    paths['alignment'] = os.path.join(outdir, 'synthetic.align')
+    write_alignment(paths['alignment'], N_SEQS * scale, seed=seed)
+    return paths
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Materialize the HPLC concentration views as indexed tables.
+
+The chain of views in schema_results.sql (peak_concentration ->
+injection_concentration -> ... -> cage_concentration) is replaced, in order,
+by tables of the same name.  Each view definition is kept as
+_<name>_view, now selecting from the materialized table one level down.
+
+Triggers on every table the views read (peak, peak_qc, calibration, the
+calibration groups and config, and the injection -> extraction -> sample ->
+mouse mapping) record which keys have changed.  Running this script again on
+an already materialized database recomputes only the rows downstream of
+those keys.  If any of the triggers were missing (e.g. in a database
+materialized by an older version of this script), changes may not have been
+recorded, so everything is recomputed.
+
+usage:
+
+    materialize_hplc.py [--full] DB
+
+"""
+
+import argparse
+import re
+import sqlite3
+import sys
+
+# (name, key column, dirty key level, index columns), from the bottom up.
+LEVELS = [ ('peak_concentration', 'injection_id', 'injection',
+            ['injection_id', 'molecule_id', 'channel', 'calibration_group'])
+         , ('injection_concentration', 'injection_id', 'injection',
+            ['injection_id', 'molecule_id', 'channel'])
+         , ('extraction_concentration', 'extraction_id', 'extraction',
+            ['extraction_id', 'molecule_id', 'channel'])
+         , ('sample_concentration', 'sample_id', 'sample',
+            ['sample_id', 'molecule_id', 'channel'])
+         , ('mouse_concentration', 'mouse_id', 'mouse',
+            ['mouse_id', 'molecule_id', 'channel'])
+         , ('cage_concentration', 'cage_id', 'cage',
+            ['cage_id', 'molecule_id', 'channel'])
+         ]
+
+DIRTY_TABLE = '_concentration_dirty'
+
+# Changes to these tables mark the keys selected (from the changed {row},
+# OLD and/or NEW) at the given level as dirty.
+TRIGGER_SOURCES = [ ('peak', 'injection', 'SELECT {row}.injection_id')
+                  , ('peak_qc', 'injection', 'SELECT {row}.injection_id')
+                  , ('calibration', 'calibration_group',
+                     'SELECT {row}.calibration_group')
+                  , ('calibration_group', 'injection',
+                     'SELECT {row}.injection_id')
+                  , ('calibration_group', 'calibration_group',
+                     'SELECT {row}.calibration_group')
+                  , ('calibration_config', 'calibration_group',
+                     'SELECT calibration_group FROM calibration '
+                     'WHERE molecule_id = {row}.molecule_id '
+                     'AND channel = {row}.channel')
+                  , ('injection', 'injection', 'SELECT {row}.injection_id')
+                  , ('injection', 'extraction', 'SELECT {row}.extraction_id')
+                  , ('extraction', 'extraction', 'SELECT {row}.extraction_id')
+                  , ('extraction', 'sample', 'SELECT {row}.sample_id')
+                  , ('sample', 'sample', 'SELECT {row}.sample_id')
+                  , ('sample', 'mouse', 'SELECT {row}.mouse_id')
+                  , ('mouse', 'mouse', 'SELECT {row}.mouse_id')
+                  , ('mouse', 'cage', 'SELECT {row}.cage_id')
+                  ]
+
+# Each level's dirty keys are found from those of the previous level.
+PROPAGATE = [ ('injection', 'calibration_group',
+               'SELECT injection_id FROM calibration_group '
+               'WHERE calibration_group IN ({})')
+            , ('extraction', 'injection',
+               'SELECT extraction_id FROM injection '
+               'WHERE injection_id IN ({})')
+            , ('sample', 'extraction',
+               'SELECT sample_id FROM extraction '
+               'WHERE extraction_id IN ({})')
+            , ('mouse', 'sample',
+               'SELECT mouse_id FROM sample '
+               'WHERE sample_id IN ({})')
+            , ('cage', 'mouse',
+               'SELECT cage_id FROM mouse '
+               'WHERE mouse_id IN ({})')
+            ]
+
+VIEW_HEAD = re.compile(r'^\s*CREATE\s+VIEW\s+\S+\s+AS', flags=re.IGNORECASE)
+
+
+def object_type(con, name):
+    row = con.execute('SELECT type FROM sqlite_master WHERE name = ?',
+                      (name,)).fetchone()
+    return row[0] if row else None
+
+
+def dirty_keys(level):
+    return "SELECT key FROM temp.dirty WHERE level = '{}'".format(level)
+
+
+def create_triggers(con):
+    """Create any missing dirty-key triggers; return how many were created."""
+    con.execute('CREATE TABLE IF NOT EXISTS {} '
+                '(level TEXT, key TEXT, PRIMARY KEY (level, key))'
+                .format(DIRTY_TABLE))
+    created = 0
+    for table, level, select in TRIGGER_SOURCES:
+        for event, rows in [('INSERT', ['NEW']),
+                            ('DELETE', ['OLD']),
+                            ('UPDATE', ['OLD', 'NEW'])]:
+            name = '_{}_{}_dirty_{}'.format(table, level, event.lower())
+            if object_type(con, name) == 'trigger':
+                continue
+            inserts = ''.join("INSERT OR IGNORE INTO {} (level, key) "
+                              "SELECT '{}', * FROM ({}); "
+                              .format(DIRTY_TABLE, level,
+                                      select.format(row=row))
+                              for row in rows)
+            con.execute('CREATE TRIGGER {} AFTER {} ON {} BEGIN {}END'
+                        .format(name, event, table, inserts))
+            created += 1
+    return created
+
+
+def materialize(con):
+    """Replace each concentration view with a table of the same name."""
+    for name, _, _, index_cols in LEVELS:
+        if object_type(con, name) == 'table':
+            continue
+        sql, = con.execute("SELECT sql FROM sqlite_master "
+                           "WHERE type = 'view' AND name = ?",
+                           (name,)).fetchone()
+        view = '_{}_view'.format(name)
+        con.execute('DROP VIEW IF EXISTS {}'.format(view))
+        con.execute(VIEW_HEAD.sub('CREATE VIEW {} AS'.format(view), sql))
+        con.execute('DROP VIEW {}'.format(name))
+        con.execute('CREATE TABLE {} AS SELECT * FROM {}'.format(name, view))
+        con.execute('CREATE INDEX idx_{0}__{1} ON {0}({2})'
+                    .format(name, index_cols[0], ', '.join(index_cols)))
+        print("Materialized {}.".format(name), file=sys.stderr)
+    create_triggers(con)
+    con.execute('DELETE FROM {}'.format(DIRTY_TABLE))
+
+
+def refresh(con, full=False):
+    """Recompute the rows downstream of all recorded changes."""
+    if full:
+        for name, _, _, _ in LEVELS:
+            con.execute('DELETE FROM {}'.format(name))
+            con.execute('INSERT INTO {0} SELECT * FROM _{0}_view'.format(name))
+        con.execute('DELETE FROM {}'.format(DIRTY_TABLE))
+        return
+
+    con.execute('CREATE TEMP TABLE dirty '
+                '(level TEXT, key TEXT, PRIMARY KEY (level, key))')
+    con.execute('INSERT INTO temp.dirty SELECT * FROM {}'.format(DIRTY_TABLE))
+    for level, parent, query in PROPAGATE:
+        con.execute("INSERT OR IGNORE INTO temp.dirty (level, key) "
+                    "SELECT '{}', * FROM ({})"
+                    .format(level, query.format(dirty_keys(parent))))
+
+    for name, key, level, _ in LEVELS:
+        keys = dirty_keys(level)
+        cur = con.execute('DELETE FROM {} WHERE {} IN ({})'
+                          .format(name, key, keys))
+        deleted = cur.rowcount
+        cur = con.execute('INSERT INTO {0} SELECT * FROM _{0}_view '
+                          'WHERE {1} IN ({2})'.format(name, key, keys))
+        print("Refreshed {}: {} rows removed, {} rows added."
+              .format(name, deleted, cur.rowcount), file=sys.stderr)
+    con.execute('DELETE FROM {}'.format(DIRTY_TABLE))
+    con.execute('DROP TABLE temp.dirty')
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--full', action='store_true',
+                   help='recompute every row, not just the changed ones')
+    p.add_argument('database', metavar='DB')
+    args = p.parse_args()
+
+    con = sqlite3.connect(args.database, isolation_level=None)
+    con.execute('BEGIN')
+    if object_type(con, LEVELS[0][0]) == 'view':
+        materialize(con)
+    else:
+        full = args.full
+        if create_triggers(con):
+            print("Some changes may not have been recorded; "
+                  "refreshing every row.", file=sys.stderr)
+            full = True
+        refresh(con, full=full)
+    con.execute('COMMIT')
+    con.execute('ANALYZE')
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,40 @@
 #!/usr/bin/env python3
+"""Extract names files (OTU -> member sequences) from a MOTHUR list file.
+
+Label rows are found through an index of the list file (built on first use;
+see lib/mothur.py), and several labels can be extracted in one pass.
+
+usage:
+
+    otus_to_names_file.py LABEL OTUS > NAMES
+    otus_to_names_file.py LABEL,LABEL,... OTUS --output '{label}.names'
+
+"""
+
+import argparse
+from lib import mothur
 
-import sys
 
 def main():
-    label = sys.argv[1]
-    otus_path = sys.argv[2]
-    with open(otus_path) as handle:
-        for line in handle:
-            if line.startswith('label'):  # Header
-                otu_names = line.strip().split('\t')[2:]
-            elif line.startswith(label):  # Our row of interest
-                seq_groups = line.strip().split('\t')[2:]
-                break
-        else:
-            raise AssertionError("The requested label, {}, was not found.".format(label))
-
-    for name, group in zip(otu_names, seq_groups):
-        print(name, group.strip(), sep='\t', file=sys.stdout)
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('labels', metavar='LABEL[,LABEL...]',
+                   help='clustering label(s) to extract, e.g. 0.03')
+    p.add_argument('otus', metavar='OTUS', help='MOTHUR list file')
+    p.add_argument('--output', '-o', metavar='TEMPLATE',
+                   help=("write each label to TEMPLATE.format(label=LABEL) "
+                         "(default: stdout, for a single label)"))
+    args = p.parse_args()
+
+    labels = args.labels.split(',')
+    if len(labels) > 1 and not args.output:
+        p.error('an --output template is required for more than one label')
+
+    list_file = mothur.ListFile(args.otus)
+    for label, names, groups in list_file.read(labels):
+        path = args.output.format(label=label) if args.output else None
+        with mothur.open_output(path) as handle:
+            mothur.write_names(handle, names, groups)
 
 if __name__ == "__main__":
     main()
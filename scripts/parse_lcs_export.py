@@ -4,6 +4,9 @@
 Usage:
 
 parse_lcs_export.py <FILE> > output.tsv
+parse_lcs_export.py --procs 4 --cache-dir <DIR> <FILE|DIR> ... > output.tsv
+parse_lcs_export.py --channel-from-name <DATE>.<CHANNEL>.lcs_export.txt ... \
+    > output.tsv
 
 
 Warning:
@@ -11,11 +14,18 @@ Warning:
 Be sure to export WITHOUT summary statistics.
 
 """
-from collections import namedtuple, OrderedDict, defaultdict
+from collections import OrderedDict
+from io import StringIO
+from multiprocessing import Pool
 import pandas as pd
 import sys
 import os
+import glob
+import hashlib
+import shutil
+import tempfile
 import argparse
+from lib import cache, instrument
 
 COL_RENAME = OrderedDict([
 #'Unnamed: 0',
@@ -62,67 +72,214 @@ COLS = list(COLS)
 NAMES = list(NAMES)
 
 
+DTYPES = {col: float for col in COLS}
+
+EXPORT_SUFFIX = '.lcs_export.txt'
+EXPORT_GLOB = '*' + EXPORT_SUFFIX
+HASH_CHUNK_SIZE = 2**20
+# Cached tables are only valid for the parser that wrote them.
+PARSER_DIGEST = cache.file_digest(os.path.abspath(__file__))
+
+
+def iter_blocks(handle):
+    """Yield (molecule_name, lines) for each table in an open export file.
+
+    Each block begins with an 'ID#' line and a 'Name' line, followed by a
+    header and one row per injection, and ends at a blank line (or the next
+    'ID#' line).  The file is read exactly once.
+
+    """
+    name = None
+    lines = None
+    for line in handle:
+        if line.startswith('ID'):
+            if name and lines:
+                yield name, lines
+            name, lines = None, None
+        elif line.startswith('Name'):
+            name = line[5:].rstrip('\r\n')
+            lines = []
+        elif lines is None:
+            continue
+        elif not line.strip():
+            if name and lines:
+                yield name, lines
+            name, lines = None, None
+        else:
+            lines.append(line)
+    if name and lines:
+        yield name, lines
+
+
+def parse_block(name, lines):
+    """Parse the lines of one block into a typed peak table."""
+    data = pd.read_table(StringIO(''.join(lines)),
+                         index_col=1, na_values='-----', dtype=DTYPES)
+    data = data[COLS]
+    data.columns = NAMES
+    data.index.name = 'injection_id'
+    data['molecule_id'] = name.lower()
+    return data
+
+
+def export_channel(path):
+    """Channel named in an export's file name (e.g. <date>.RI.lcs_export.txt)."""
+    name = os.path.basename(path)
+    if name.endswith(EXPORT_SUFFIX):
+        parts = name[:-len(EXPORT_SUFFIX)].split('.')
+        if len(parts) > 1:
+            return parts[-1]
+    return None
+
+
+def file_constants(path, const_cols, channel_from_name=False):
+    """The constant columns for *path*, with its channel if requested."""
+    const_cols = OrderedDict(const_cols)
+    if channel_from_name:
+        channel = export_channel(path)
+        if channel is None:
+            raise ValueError("No channel found in the name of {}"
+                             .format(path))
+        const_cols['channel'] = channel
+    return const_cols
+
+
+def iter_tables(paths, const_cols, channel_from_name=False):
+    """Yield one peak table per molecule block across all *paths*.
+
+    Each table is filled out with *const_cols* (and, with
+    *channel_from_name*, the channel from its file's name).
+
+    """
+    for path in paths:
+        found = False
+        path_cols = file_constants(path, const_cols, channel_from_name)
+        with open(path) as handle:
+            for name, lines in iter_blocks(handle):
+                found = True
+                data = parse_block(name, lines)
+                for key in path_cols:
+                    data[key] = path_cols[key]
+                yield data
+        if not found:
+            print("No tables found in {}".format(path), file=sys.stderr)
+
+
+def write_tables(tables, handle, const_cols):
+    """Write peak *tables* to *handle* as one TSV with a single header.
+
+    *const_cols* names the constant columns, for the header if there are
+    no tables.  Returns the number of rows written.
+
+    """
+    header = True
+    nrows = 0
+    for data in tables:
+        data.to_csv(handle, sep='\t', header=header)
+        header = False
+        nrows += len(data)
+
+    if header:  # No tables found; write just the header.
+        empty = pd.DataFrame(columns=NAMES + ['molecule_id'] + list(const_cols))
+        empty.index.name = 'injection_id'
+        empty.to_csv(handle, sep='\t')
+    return nrows
+
+
+def expand_paths(paths):
+    """Replace directories in *paths* with the export files they contain."""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, EXPORT_GLOB)))
+        else:
+            yield path
+
+
+def cache_key(path, const_cols):
+    """Hash the contents of *path*, the constant columns and the parser."""
+    digest = hashlib.sha1(PARSER_DIGEST.encode())
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    for key, value in sorted(const_cols.items()):
+        digest.update('\0{}={}'.format(key, value).encode())
+    return digest.hexdigest()
+
+
+def parse_cached(args):
+    """Parse one export into *cache_dir*, unless it is already there.
+
+    Returns the path to the cached peak table.
+
+    """
+    path, const_cols, cache_dir = args
+    cache_path = os.path.join(cache_dir, cache_key(path, const_cols) + '.tsv')
+    if not os.path.exists(cache_path):
+        temp_path = '{}.{}.temp'.format(cache_path, os.getpid())
+        with open(temp_path, 'w') as handle:
+            write_tables(iter_tables([path], const_cols), handle, const_cols)
+        os.replace(temp_path, cache_path)
+    return cache_path
+
+
+def concat_cached(cache_paths, handle):
+    """Copy cached peak tables to *handle*, keeping only the first header."""
+    for i, cache_path in enumerate(cache_paths):
+        with open(cache_path) as cached:
+            header = next(cached)
+            if i == 0:
+                handle.write(header)
+            shutil.copyfileobj(cached, handle)
+
+
 def main():
 
     p = argparse.ArgumentParser()
     p.add_argument('--constant', '-c', type=str, metavar='KEY=VALUE',
                    help='fill an entire row with one value', action='append',
                    default=[])
-    p.add_argument('paths', metavar='FILE', type=str, nargs='+')
+    p.add_argument('--channel-from-name', action='store_true',
+                   help=("fill a 'channel' column from each file's name "
+                         "(<NAME>.<CHANNEL>.lcs_export.txt)"))
+    p.add_argument('--cache-dir', metavar='DIR',
+                   help=('cache parsed tables here, keyed by file contents '
+                         'and constants (implies batch mode)'))
+    p.add_argument('--procs', '-p', type=int, default=1,
+                   help='parse files across this many processes '
+                        '(implies batch mode)')
+    p.add_argument('paths', metavar='FILE', type=str, nargs='+',
+                   help='export file, or directory of *.lcs_export.txt files')
     args = p.parse_args()
 
-    const_cols = dict(pair.split('=', 1) for pair in args.constant)
-
-    mol_lines = OrderedDict()
-    Bounds = namedtuple('Bounds', ['start', 'stop'])
+    const_cols = OrderedDict(pair.split('=', 1) for pair in args.constant)
+    if args.channel_from_name and 'channel' in const_cols:
+        p.error("--channel-from-name can't be used with --constant channel")
+    paths = list(expand_paths(args.paths))
 
-    tables = []
+    if not (args.cache_dir or args.procs > 1):
+        header_cols = list(const_cols) + (['channel']
+                                          if args.channel_from_name else [])
+        with instrument.stage('parse') as stage:
+            stage.rows = write_tables(
+                    iter_tables(paths, const_cols, args.channel_from_name),
+                    sys.stdout, header_cols)
+        return
 
-
-    for path in args.paths:
-        with open(path) as handle:
-            start = None
-            name = ''
-            stop = None
-            for i, line in enumerate(handle):
-                if line.startswith('ID'):
-                    if name:
-                        assert start != None
-                        stop = i - 2
-                        mol_lines[name] = Bounds(start, stop)
-                    start = i + 2
-                if line.startswith('Name'):
-                    name = line[5:-1]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_dir = args.cache_dir or temp_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        jobs = [(path, file_constants(path, const_cols,
+                                      args.channel_from_name),
+                 cache_dir)
+                for path in paths]
+        with instrument.stage('parse', rows=len(jobs)):
+            if args.procs > 1:
+                with Pool(args.procs) as pool:
+                    cache_paths = pool.map(parse_cached, jobs)
             else:
-                if not start:  # Never found a table
-                    print("No tables found in {}".format(path), file=sys.stderr)
-                    continue
-                else:
-                    stop = i
-                    mol_lines[name] = Bounds(start, stop)
-
-        for mol in mol_lines:
-            start, stop = mol_lines[mol]
-            data = pd.read_table(path,
-                                skiprows=start, nrows=stop - start,
-                                index_col=1, na_values='-----')
-            data = data[COLS]
-            data.columns = NAMES
-            data.index.name = 'injection_id'
-            data['molecule_id'] = mol.lower()
-            tables.append(data)
-
-    columns = list(COL_RENAME.values()) + ['molecule_id']
-
-    if tables:
-        full_data = pd.concat(tables)
-    else:
-        full_data = pd.DataFrame(columns=columns)
-        full_data.index.name = 'injection_id'
-    for key in const_cols:
-        full_data[key] = const_cols[key]
-
-    full_data.to_csv(sys.stdout, sep='\t')
+                cache_paths = list(map(parse_cached, jobs))
+        with instrument.stage('concat'):
+            concat_cached(cache_paths, sys.stdout)
 
 
 if __name__ == '__main__':
@@ -1,20 +1,57 @@
 #!/usr/bin/env python3
+"""Write the OTU membership of sequences as a "sparse" taxonomy tsv.
+
+Each member sequence (taxon_level) gets its OTU (taxon_level_b) as a parent,
+with a confidence of 100.  Memberships are read from a names file or, with
+--labels, straight from a MOTHUR list file, for any number of labels in one
+pass (taxon_level_b is then 'otu-<label>' by default).
+
+usage:
+
+    parse_names_as_taxonomy.py NAMES TAXON_LEVEL TAXON_LEVEL_B > OUT
+    parse_names_as_taxonomy.py --labels 0.03,0.05 OTUS TAXON_LEVEL > OUT
+
+"""
 # res/%.clust.otu-tax.tsv: scripts/parse_names_as_taxonomy.py res/%.clust.names
 # 	$^ unique otu-0.03 > $@
 
-import sys
+import argparse
+from lib import mothur
+
+OUT_COLS = ['taxon_id', 'taxon_level', 'taxon_id_b', 'taxon_level_b',
+            'confidence']
+
 
 def main():
-    taxon_level = sys.argv[2]
-    taxon_level_b = sys.argv[3]
-    print('taxon_id', 'taxon_level', 'taxon_id_b', 'taxon_level_b', 'confidence', sep='\t')
-    with open(sys.argv[1]) as handle:
-        for line in handle:
-            taxon_id_b, subseqs_string = line.split('\t')
-            for taxon_id in subseqs_string.strip().split(','):
-                print(taxon_id, taxon_level, taxon_id_b, taxon_level_b, '100', sep='\t')
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('source', metavar='NAMES|OTUS',
+                   help='names file (or list file, with --labels)')
+    p.add_argument('taxon_level', metavar='TAXON_LEVEL')
+    p.add_argument('taxon_level_b', metavar='TAXON_LEVEL_B', nargs='?',
+                   help=("level of the OTUs; with --labels, formatted with "
+                         "the label (default: 'otu-{label}')"))
+    p.add_argument('--labels', metavar='LABEL[,LABEL...]',
+                   help='read these labels from a MOTHUR list file')
+    args = p.parse_args()
+
+    with mothur.open_output() as out:
+        print(*OUT_COLS, sep='\t', file=out)
+        if args.labels:
+            level_b = args.taxon_level_b or 'otu-{label}'
+            list_file = mothur.ListFile(args.source)
+            for label, names, groups in list_file.read(args.labels.split(',')):
+                members = ((name, group.strip().split(','))
+                           for name, group in zip(names, groups))
+                mothur.write_taxonomy(out, members, args.taxon_level,
+                                      level_b.format(label=label))
+        else:
+            if not args.taxon_level_b:
+                p.error('TAXON_LEVEL_B is required for a names file')
+            with open(args.source) as handle:
+                mothur.write_taxonomy(out, mothur.iter_names(handle),
+                                      args.taxon_level, args.taxon_level_b)
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,9 +1,21 @@
 #!/usr/bin/env python3
+"""Convert a MOTHUR taxonomy table into a "sparse" (long-format) taxonomy tsv.
+
+The table is read in chunks of rows, and the taxonomy strings
+('Bacteria(100);Bacteroidetes(100);...;') are split with vectorized string
+methods, so files larger than memory can be converted.  Duplicate rows are
+dropped within each chunk.
+
+usage:
+
+    parse_otu_taxonomy.py TAXON_LEVEL [TAXONOMY] > OUT
+
+"""
 
 import sys
 import pandas as pd
-import re
 import numpy as np
+from lib import instrument
 
 LEVELS = [ 'domain'
          , 'phylum'
@@ -15,37 +27,53 @@ LEVELS = [ 'domain'
          , 'strain'
          ]
 
+OUT_COLS = [ 'taxon_id'
+           , 'taxon_level'
+           , 'taxon_id_b'
+           , 'taxon_level_b'
+           , 'confidence' ]
+
+CHUNK_SIZE = 100000  # rows
+
+
+def parse_chunk(tax, taxon_level, n_levels):
+    """Return the long-format taxonomy for one chunk of the table."""
+    assigned = (tax.tax_string
+                   .str.strip(';')
+                   .str.split(';', expand=True)
+                   .reindex(columns=range(n_levels))
+                   .replace(r'^\s*$', np.nan, regex=True))
+    assigned.index = tax.taxon_id.values
+    assigned.index.name = 'taxon_id'
+    assigned.columns = pd.Index(LEVELS[:n_levels], name='taxon_level_b')
+
+    cells = assigned.stack()
+    parts = cells.str.strip(')').str.split('(')
+    out = pd.DataFrame({ 'taxon_id_b': parts.str[0]
+                       , 'confidence': parts.str[1]
+                       }).reset_index()
+    out['taxon_level'] = taxon_level
+    return out[OUT_COLS].drop_duplicates()
+
 
 def main():
     if len(sys.argv) < 3:
-        tax = pd.read_table(sys.stdin)
+        handle = sys.stdin
     else:
-        tax = pd.read_table(sys.argv[2])
-    tax.rename(columns={'OTU': 'taxon_id', 'Taxonomy': 'tax_string'}, inplace=True)
-    tax.set_index('taxon_id', inplace=True)
-    tax.drop(['Size'], axis='columns', inplace=True)
-
-    n_levels = len(tax.tax_string[0].split(';')) - 1
-    tax[LEVELS[:n_levels]] = (tax.tax_string
-                                 .str.strip(';')
-                                 .str.split(';')
-                                 .apply(pd.Series)
-                                 .replace('^\s*$', np.nan, regex=True))
-    tax = tax.drop('tax_string', axis='columns')
-    tax.columns.name = 'taxon_level_b'
-
-    out = (tax.stack()
-              .apply(lambda s: pd.Series(s.strip(')').split('(')))
-              .reset_index()
-              .rename(columns={0: 'taxon_id_b', 1: 'confidence'}))
-    out['taxon_level'] = sys.argv[1]
-    out = out[[ 'taxon_id'
-              , 'taxon_level'
-              , 'taxon_id_b'
-              , 'taxon_level_b'
-              , 'confidence' ]].drop_duplicates().reset_index(drop=True)
-
-    out.to_csv(sys.stdout, sep='\t', index=False)
+        handle = sys.argv[2]
+    chunks = pd.read_table(handle, chunksize=CHUNK_SIZE, dtype=str)
+
+    n_levels = None
+    with instrument.stage('parse') as stage:
+        for tax in chunks:
+            tax = tax.rename(columns={'OTU': 'taxon_id',
+                                      'Taxonomy': 'tax_string'})
+            header = n_levels is None
+            if header:
+                n_levels = len(tax.tax_string.iloc[0].split(';')) - 1
+            out = parse_chunk(tax, sys.argv[1], n_levels)
+            out.to_csv(sys.stdout, sep='\t', index=False, header=header)
+            stage.add_rows(len(out))
 
 if __name__ == "__main__":
     main()
@@ -1,21 +1,83 @@
 #!/usr/bin/env python3
-# Convert a MOTHUR formatted count table into a "sparse" read_count tsv.
+"""Convert a MOTHUR formatted count table into a "sparse" read_count tsv.
 
-# import pandas as pd
+The count table is read in chunks of rows; nonzero tallies are found with
+vectorized comparisons and written out through a large buffer, or, with
+--db, inserted straight into a table of an SQLite database.
+
+usage:
+
+    pivot_count_table.py [--db DB [--table TABLE]] COUNT_TABLE
+
+"""
+
+import argparse
+import io
+import sqlite3
 import sys
+import numpy as np
+import pandas as pd
+from lib import instrument
+
+CHUNK_SIZE = 10000  # count table rows
+BUFFER_SIZE = 2**22
+OUT_COLS = ['rrs_library_id', 'taxon_level', 'taxon_id', 'tally']
+TAXON_LEVEL = 'unique'
+
+
+def iter_tallies(path, chunksize=CHUNK_SIZE):
+    """Yield a DataFrame of the nonzero tallies in each chunk of rows."""
+    with open(path) as handle:
+        header = handle.readline().rstrip('\n').split('\t')
+    library_ids = np.array(header[2:], dtype=object)
+    chunks = pd.read_csv(path, sep='\t', index_col=0, chunksize=chunksize,
+                         dtype={header[0]: str})
+    for chunk in chunks:
+        tallies = chunk.values[:, 1:]  # Skip the 'total' column.
+        rows, cols = np.nonzero(tallies)
+        yield pd.DataFrame({ 'rrs_library_id': library_ids[cols]
+                           , 'taxon_level': TAXON_LEVEL
+                           , 'taxon_id': chunk.index.values[rows]
+                           , 'tally': tallies[rows, cols]
+                           }, columns=OUT_COLS)
+
 
 def main():
-    with open(sys.argv[1]) as handle:
-        header_line = next(handle)
-        library_ids = header_line.split()[2:]
-        print('rrs_library_id', 'taxon_level', 'taxon_id', 'tally',
-              sep='\t', file=sys.stdout)
-        for line in handle:
-            taxon_id, _, *tallies = line.split()
-            for library_id, tally in zip(library_ids, tallies):
-                if tally != '0':
-                    print(library_id, 'unique', taxon_id, tally, sep='\t',
-                          file=sys.stdout)
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--db', metavar='DB',
+                   help='insert the tallies into this database instead')
+    p.add_argument('--table', default='_rrs_library_taxon_count',
+                   help='table to insert into with --db (default: %(default)s)')
+    p.add_argument('--chunksize', type=int, default=CHUNK_SIZE,
+                   metavar='ROWS', help='count table rows read at a time')
+    p.add_argument('count_table', metavar='COUNT_TABLE')
+    args = p.parse_args()
+
+    if args.db:
+        con = sqlite3.connect(args.db, isolation_level=None)
+        con.execute('BEGIN')
+        statement = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+                args.table, ', '.join(OUT_COLS),
+                ', '.join('?' for _ in OUT_COLS))
+        with instrument.stage('pivot') as stage:
+            for tallies in iter_tallies(args.count_table, args.chunksize):
+                con.executemany(statement, zip(*(tallies[col].tolist()
+                                                 for col in OUT_COLS)))
+                stage.add_rows(len(tallies))
+            con.execute('COMMIT')
+        con.close()
+        print("Imported {} rows into {}.".format(stage.rows or 0, args.table),
+              file=sys.stderr)
+        return
+
+    with instrument.stage('pivot') as stage, \
+            io.open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE,
+                    closefd=False) as handle:
+        print(*OUT_COLS, sep='\t', file=handle)
+        for tallies in iter_tallies(args.count_table, args.chunksize):
+            tallies.to_csv(handle, sep='\t', header=False, index=False)
+            stage.add_rows(len(tallies))
 
 
 if __name__ == "__main__":
@@ -1,39 +1,183 @@
 #!/usr/bin/env python3
-import pandas as pd
-from scipy.stats import linregress
+"""Injection-level quality control for HPLC peaks.
+
+For each injection and channel, retention times (tip) are regressed on each
+molecule's retention_constant; a peak's retention_deviation is its fractional
+deviation from that fit.  All injections are fit at once from grouped sums.
+Injections with fewer than two usable peaks (or only one distinct
+retention_constant) can't be fit and get a NaN retention_deviation.  Plate
+counts are estimated from the half-height width (plates_hph) and from the
+area/height ratio (plates_ah).
+
+With --stream, LC Solutions exports are parsed one at a time (as by
+parse_lcs_export.py), and each export's QC rows are written as soon as it's
+parsed.  Peaks out of tolerance are reported on stderr as they are found.
+
+usage:
+
+    qc_hplc.py PEAK MOLECULE > OUT
+    qc_hplc.py --stream [--channel RI] MOLECULE EXPORT [EXPORT ...] > OUT
+
+"""
+
+import argparse
 import sys
 from math import pi
+import numpy as np
+import pandas as pd
+from lib import instrument
+from parse_lcs_export import export_channel, iter_blocks, parse_block
+
+INDEX_COLS = ['injection_id', 'molecule_id', 'channel']
+OUT_COLS = ['retention_deviation', 'plates_hph', 'plates_ah']
+
+MAX_DEVIATION = 0.03
+MIN_PLATES = 1000
+
+
+def segment_sum(codes, values, n):
+    return np.bincount(codes, weights=values, minlength=n)
 
 
 def retention_deviation(data):
-    out = data.set_index('molecule_id').dropna(subset=['retention_constant', 'tip'])
-    # This checks if the injection/channel had no peaks.
-    # TODO: What if it has just one peak?
-    if out.empty:
-        out['retention_deviation'] = float('nan')
-    else:
-        slope, intercept, *_ = linregress(out.retention_constant, out.tip)
-        out['expected_tip'] = out.retention_constant * slope + intercept
-        out['retention_deviation'] = (out.tip - out.expected_tip) / out.expected_tip
-    return out.retention_deviation
+    """Fractional deviation of tip from each injection/channel's fit.
+
+    *data* must have injection_id, channel, retention_constant and tip, with
+    no missing values in the latter two.
+
+    """
+    codes = data.groupby(['injection_id', 'channel'], sort=False).ngroup().values
+    n_groups = codes.max() + 1 if len(codes) else 0
+    x = data.retention_constant.values.astype(float)
+    y = data.tip.values.astype(float)
+
+    nobs = segment_sum(codes, None, n_groups)
+    x_mean = segment_sum(codes, x, n_groups) / nobs
+    y_mean = segment_sum(codes, y, n_groups) / nobs
+    dx = x - x_mean[codes]
+    dy = y - y_mean[codes]
+    sxx = segment_sum(codes, dx * dx, n_groups)
+    sxy = segment_sum(codes, dx * dy, n_groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where((nobs > 1) & (sxx > 0), sxy / sxx, np.nan)
+        intercept = y_mean - slope * x_mean
+        expected = x * slope[codes] + intercept[codes]
+        return (y - expected) / expected
+
+
+def quality(peak, molecule):
+    """QC table for each peak with a tip and a known retention_constant.
+
+    Rows are ordered by injection and channel, and otherwise in the order of
+    *peak*.
+
+    """
+    data = (peak.join(molecule[['retention_constant']], on='molecule_id')
+                .dropna(subset=['retention_constant', 'tip']))
+    # Stable, so peaks stay in their original order within an injection.
+    data = data.sort_values(['injection_id', 'channel'], kind='mergesort')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plates_hph = 5.54 * (data.tip / data.width_50) ** 2
+        plates_ah = 2 * pi * (data.tip * data.height / data.area) ** 2
+    out = data[INDEX_COLS].assign(
+            retention_deviation=retention_deviation(data),
+            plates_hph=plates_hph.replace([np.inf, -np.inf], np.nan),
+            plates_ah=plates_ah)
+    return out.set_index(INDEX_COLS)[OUT_COLS]
+
+
+def flag(qc, max_deviation=MAX_DEVIATION, min_plates=MIN_PLATES):
+    """Boolean Series marking peaks out of tolerance.
+
+    A peak is flagged if the absolute retention_deviation is greater than
+    *max_deviation*, or plates_hph is below *min_plates*.  (plates_ah mixes
+    the time units of tip and area, so it isn't compared.)  Missing values
+    are never flagged.
+
+    """
+    return ((qc.retention_deviation.abs() > max_deviation)
+            | (qc.plates_hph < min_plates))
+
+
+def iter_exports(paths, channel=None):
+    """Yield (path, peak table) for each LC Solutions export, as parsed."""
+    for path in paths:
+        chan = channel or export_channel(path)
+        if chan is None:
+            raise ValueError("No channel given or found in the name of {}"
+                             .format(path))
+        with open(path) as handle:
+            tables = [parse_block(name, lines)
+                      for name, lines in iter_blocks(handle)]
+        if not tables:
+            print("No tables found in {}".format(path), file=sys.stderr)
+            continue
+        peak = pd.concat(tables).reset_index()
+        peak['channel'] = chan
+        yield path, peak
+
+
+def report_flagged(qc, flagged, handle):
+    for (injection_id, molecule_id, channel), row in qc[flagged].iterrows():
+        print('FLAG', injection_id, molecule_id, channel,
+              *['{:.4g}'.format(row[c]) for c in OUT_COLS],
+              sep='\t', file=handle)
 
 
 def main():
-    peak = pd.read_table(sys.argv[1])
-    molecule = pd.read_table(sys.argv[2], index_col=0)
-    out = (peak.join(molecule, on='molecule_id')
-               .groupby(['injection_id', 'channel'])
-               .apply(retention_deviation)
-               .to_frame())
-
-    peak['plates_hph'] = 5.54 * (peak.tip / peak.width_50) ** 2
-    peak['plates_hph'] = peak['plates_hph'].replace(float('inf'), float('nan'))
-    peak['plates_ah'] = 2 * pi * (peak.tip * peak.height / peak.area) ** 2
-    peak = peak.set_index(['injection_id', 'molecule_id', 'channel'])
-
-    out[['plates_hph', 'plates_ah']] = peak[['plates_hph', 'plates_ah']]
-    out = out.reset_index().set_index(['injection_id', 'molecule_id', 'channel'])
-    out.to_csv(sys.stdout, sep='\t')
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('paths', nargs='+', metavar='PATH',
+                   help='PEAK MOLECULE, or with --stream, MOLECULE EXPORT ...')
+    p.add_argument('--stream', action='store_true',
+                   help='parse LC Solutions exports and check each in turn')
+    p.add_argument('--channel',
+                   help='channel of every export (default: from file names)')
+    p.add_argument('--max-deviation', type=float, default=MAX_DEVIATION,
+                   help='flag larger absolute retention_deviation '
+                        '(default: %(default)s)')
+    p.add_argument('--min-plates', type=float, default=MIN_PLATES,
+                   help='flag smaller plates_hph (default: %(default)s)')
+    args = p.parse_args()
+    tolerance = dict(max_deviation=args.max_deviation,
+                     min_plates=args.min_plates)
+
+    if not args.stream:
+        if len(args.paths) != 2:
+            p.error('expected PEAK and MOLECULE')
+        with instrument.stage('read') as stage:
+            peak = pd.read_table(args.paths[0])
+            molecule = pd.read_table(args.paths[1], index_col=0)
+            stage.rows = len(peak)
+        with instrument.stage('qc') as stage:
+            qc = quality(peak, molecule)
+            stage.rows = len(qc)
+        with instrument.stage('write'):
+            qc.to_csv(sys.stdout, sep='\t')
+        print("{} of {} peaks out of tolerance"
+              .format(flag(qc, **tolerance).sum(), len(qc)), file=sys.stderr)
+        return
+
+    if len(args.paths) < 2:
+        p.error('expected MOLECULE and at least one EXPORT')
+    molecule = pd.read_table(args.paths[0], index_col=0)
+    header = True
+    for path, peak in iter_exports(args.paths[1:], args.channel):
+        with instrument.stage('qc') as stage:
+            qc = quality(peak, molecule)
+            stage.rows = len(qc)
+        qc.to_csv(sys.stdout, sep='\t', header=header)
+        sys.stdout.flush()
+        header = False
+        flagged = flag(qc, **tolerance)
+        print("{}: {} of {} peaks out of tolerance"
+              .format(path, flagged.sum(), len(qc)), file=sys.stderr)
+        report_flagged(qc, flagged, sys.stderr)
+    if header:  # No exports parsed; write just the header.
+        print(*(INDEX_COLS + OUT_COLS), sep='\t')
+
 
 if __name__ == "__main__":
     main()
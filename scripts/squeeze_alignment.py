@@ -1,33 +1,134 @@
 #!/usr/bin/env python3
+"""Remove alignment columns made up entirely of the given characters.
 
-from Bio.AlignIO import read
-from tqdm import tqdm
+The aligned FASTA is loaded into a uint8 matrix (one byte per position;
+optionally spooled to a temporary file and memory-mapped), columns to drop
+are found with a lookup table over blocks of rows, and the remaining
+columns are written out by slicing rows.
+
+usage:
+
+    squeeze_alignment.py [--mmap [--temp-dir DIR]] CHARS [FASTA] > OUT
+
+e.g. `squeeze_alignment.py '-.acgtu' < in.afn > out.afn`
+
+"""
+
+import argparse
 import sys
+import tempfile
 import numpy as np
+from lib import instrument
+
+BLOCK_SIZE = 2**26  # bytes of the matrix processed at a time
+
+
+def iter_fasta(handle):
+    """Yield (id, sequence) as bytes for each record of a FASTA file."""
+    title, lines = None, []
+    for line in handle:
+        if line.startswith(b'>'):
+            if title is not None:
+                yield title, b''.join(lines)
+            title, lines = line[1:].strip(), []
+        elif title is not None:
+            lines.append(line.strip().replace(b' ', b''))
+    if title is not None:
+        yield title, b''.join(lines)
+
+
+def read_alignment(handle, spool=None):
+    """Load an aligned FASTA file into a (sequences x columns) uint8 matrix.
+
+    Returns (ids, matrix).  If *spool* (an open binary file) is given, the
+    rows are written there and the matrix is memory-mapped from it.
+
+    """
+    ids = []
+    length = None
+    data = bytearray()
+    for title, seq in iter_fasta(handle):
+        ids.append(title.split(None, 1)[0] if title else b'')
+        if length is None:
+            length = len(seq)
+        elif len(seq) != length:
+            raise ValueError("Sequences must all be the same length "
+                             "({} is {}, not {})".format(ids[-1].decode(),
+                                                         len(seq), length))
+        if spool is None:
+            data += seq
+        else:
+            spool.write(seq)
+    shape = (len(ids), length or 0)
+    if spool is None:
+        return ids, np.frombuffer(data, dtype=np.uint8).reshape(shape)
+    spool.flush()
+    if shape[0] * shape[1] == 0:
+        return ids, np.empty(shape, dtype=np.uint8)
+    return ids, np.memmap(spool.name, dtype=np.uint8, mode='r', shape=shape)
+
+
+def iter_blocks(matrix):
+    """Yield (start, stop) row ranges of about BLOCK_SIZE bytes."""
+    step = max(1, BLOCK_SIZE // max(1, matrix.shape[1]))
+    for start in range(0, matrix.shape[0], step):
+        yield start, min(start + step, matrix.shape[0])
+
+
+def keep_columns(matrix, remove_chars):
+    """Boolean mask of columns with any character not in *remove_chars*."""
+    removable = np.zeros(256, dtype=bool)
+    removable[np.frombuffer(remove_chars, dtype=np.uint8)] = True
+    only_removable = np.ones(matrix.shape[1], dtype=bool)
+    for start, stop in iter_blocks(matrix):
+        only_removable &= removable[matrix[start:stop]].all(axis=0)
+    return ~only_removable
 
-def contains_only(col, values):
-    return set(col) - set(values) == set()
 
 def main():
-    alignment = read(sys.stdin, 'fasta')
-    remove_chars = np.asarray(list(sys.argv[1]))
-    length = alignment.get_alignment_length()
-    print("Num sequences: %d" % len(alignment), file=sys.stderr)
-    print("Alignment length: %d" % length, file=sys.stderr)
-
-    keep_cols = []
-    for i in tqdm(range(length)):
-        if not contains_only(alignment[:,i], remove_chars):
-            keep_cols.append(i)
-
-    out = np.empty((len(alignment), len(keep_cols)), dtype='<U1')
-    for i, j in tqdm(enumerate(keep_cols), total=len(keep_cols)):
-        out[:,i] = np.array(list(alignment[:,j]))
-
-    print("Remaining columns: %d" % out.shape[1], file=sys.stderr)
-    for i, seq in enumerate(alignment):
-        print(">" + seq.id)
-        print(''.join(out[i,:]))
+    # CHARS usually starts with '-', so positional arguments are taken from
+    # whatever isn't a recognized option.
+    p = argparse.ArgumentParser(description=__doc__,
+                                usage='%(prog)s [--mmap [--temp-dir DIR]] '
+                                      'CHARS [FASTA]',
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--mmap', action='store_true',
+                   help='keep the alignment in a memory-mapped temporary file')
+    p.add_argument('--temp-dir', metavar='DIR',
+                   help='directory for the --mmap file')
+    args, positional = p.parse_known_args()
+    if len(positional) not in (1, 2):
+        p.error('expected CHARS and optionally FASTA')
+    chars = positional[0]
+    if len(positional) == 2:
+        fasta = open(positional[1], 'rb')
+    else:
+        fasta = sys.stdin.buffer
+
+    if args.mmap:
+        spool = tempfile.NamedTemporaryFile(dir=args.temp_dir,
+                                            prefix='squeeze-', suffix='.u8')
+    else:
+        spool = None
+    with instrument.stage('read') as stage:
+        ids, matrix = read_alignment(fasta, spool)
+        stage.rows = matrix.shape[0]
+    print("Num sequences: %d" % matrix.shape[0], file=sys.stderr)
+    print("Alignment length: %d" % matrix.shape[1], file=sys.stderr)
+
+    with instrument.stage('mask'):
+        keep = keep_columns(matrix, chars.encode())
+    print("Remaining columns: %d" % keep.sum(), file=sys.stderr)
+    with instrument.stage('write', rows=matrix.shape[0]):
+        out = sys.stdout.buffer
+        for start, stop in iter_blocks(matrix):
+            block = matrix[start:stop][:, keep]
+            for seq_id, row in zip(ids[start:stop], block):
+                out.write(b'>' + seq_id + b'\n' + row.tobytes() + b'\n')
+        out.flush()
+    if spool is not None:
+        del matrix
+        spool.close()
 
 
 if __name__ == '__main__':
@@ -1,26 +1,64 @@
 #!/usr/bin/env python3
+"""Convert a MOTHUR shared file into a "sparse" read_count tsv.
 
-import pandas as pd
+The shared file is streamed one row (library and label) at a time, and only
+nonzero tallies are written, so memory use is bounded by a single row no
+matter how many OTUs or labels there are.  Each label becomes a taxon_level
+of 'otu-<label>'.
+
+usage:
+
+    stack_shared.py SHARED
+
+"""
+
+import io
 import sys
+import numpy as np
+from lib import instrument
+
+BUFFER_SIZE = 2**22
+OUT_COLS = ['rrs_library_id', 'taxon_level', 'taxon_id', 'tally']
+
+
+def iter_tallies(handle):
+    """Yield (rrs_library_id, taxon_level, taxon_ids, tallies) for each row.
+
+    Only the nonzero tallies (as strings) and their OTUs are included;
+    empty fields, like those left by MOTHUR's trailing tabs, are skipped.
+
+    """
+    otus = None
+    for line in handle:
+        fields = line.rstrip('\t\r\n').split('\t')
+        # Some shared files repeat the header for each label.
+        if fields[0] == 'label':
+            otus = np.array(fields[3:], dtype=object)
+            continue
+        label, library_id, _, *tallies = fields
+        tallies = np.array(tallies, dtype=object)
+        assert len(tallies) <= len(otus)
+        nonzero = np.flatnonzero((tallies != '0') & (tallies != '')
+                                 & (otus[:len(tallies)] != ''))
+        yield (library_id, 'otu-{}'.format(label),
+               otus[nonzero], tallies[nonzero])
+
 
 def main():
-    shared = pd.read_table(sys.argv[1])
-
-    shared['rrs_library_id'] = shared.Group
-    shared = shared.drop('Group', axis='columns')
-    shared['taxon_level'] = shared['label'].apply(lambda x: 'otu-{}'.format(x))
-    shared = shared.drop('label', axis='columns')
-    shared = shared.drop('numOtus', axis='columns')
-
-
-    shared = shared.set_index(['rrs_library_id', 'taxon_level'])
-    shared = shared.stack()
-    shared = shared[shared != 0]
-    shared.name = 'tally'
-    shared = shared.to_csv(sys.stdout,
-                           sep='\t',
-                           header=True,
-                           index_label=('rrs_library_id', 'taxon_level', 'taxon_id'))
+    if len(sys.argv) != 2:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    with instrument.stage('stack') as stage, \
+            open(sys.argv[1]) as handle, \
+            io.open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE,
+                    closefd=False) as out:
+        print(*OUT_COLS, sep='\t', file=out)
+        for library_id, level, otus, tallies in iter_tallies(handle):
+            prefix = '{}\t{}\t'.format(library_id, level)
+            out.writelines(prefix + otu + '\t' + tally + '\n'
+                           for otu, tally in zip(otus, tallies))
+            stage.add_rows(len(otus))
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Summarize the stage records of one pipeline run by target and stage.
+
+Reads the JSON lines appended by lib/instrument.py (e.g. from
+`make all PROFILE_LOG=build/profile.jsonl`) and writes a TSV with one row for
+each make target and stage: the number of times it ran, total wall and CPU
+seconds, peak RSS and total rows.  Targets are ordered by their total wall
+time, largest first, and each target also gets a '*' row with its totals.
+The share of the run's wall time taken by each target is printed to stderr.
+
+By default the latest run in the log is summarized.
+
+usage:
+
+    summarize_profile.py [--run RUN | --all] LOG > OUT
+
+"""
+
+import argparse
+import sys
+import pandas as pd
+
+TOTAL = '*'
+OUT_COLS = [ 'target'
+           , 'script'
+           , 'stage'
+           , 'calls'
+           , 'wall_seconds'
+           , 'cpu_seconds'
+           , 'max_rss_mib'
+           , 'rows'
+           ]
+
+
+def read_log(path):
+    log = pd.read_json(path, lines=True, dtype=False)
+    for col in ['run', 'target', 'rows', 'depth']:
+        if col not in log:
+            log[col] = None
+    log['depth'] = log.depth.fillna(0)
+    # Outside of make, the script stands in for the target.
+    log['target'] = log.target.where(log.target.notnull(), log.script)
+    log['run'] = log.run.fillna('')
+    return log
+
+
+def summarize(log):
+    grouped = log.groupby(['target', 'script', 'stage'], sort=False)
+    stages = pd.DataFrame({ 'calls': grouped.size()
+                          , 'wall_seconds': grouped.wall_seconds.sum()
+                          , 'cpu_seconds': grouped.cpu_seconds.sum()
+                          , 'max_rss_mib': grouped.max_rss_mib.max()
+                          , 'rows': grouped.rows.sum(min_count=1)
+                          }).reset_index()
+
+    # Stages can nest (e.g. load_data's loaders), so target totals are
+    # taken from the outermost stages only.
+    grouped = log[log.depth == 0].groupby(['target', 'script'], sort=False)
+    totals = pd.DataFrame({ 'calls': grouped.pid.nunique()
+                          , 'wall_seconds': grouped.wall_seconds.sum()
+                          , 'cpu_seconds': grouped.cpu_seconds.sum()
+                          , 'max_rss_mib': grouped.max_rss_mib.max()
+                          }).reset_index().assign(stage=TOTAL)
+
+    order = (totals.groupby('target').wall_seconds.sum()
+                   .sort_values(ascending=False))
+    out = pd.concat([totals, stages], ignore_index=True, sort=False)
+    out['target_order'] = out.target.map(
+            pd.Series(range(len(order)), index=order.index))
+    out['is_stage'] = out.stage != TOTAL
+    out = out.sort_values(['target_order', 'script', 'is_stage'],
+                          kind='mergesort')
+    return out[OUT_COLS], order
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('log', metavar='LOG')
+    p.add_argument('--run', help='summarize this run (default: the latest)')
+    p.add_argument('--all', action='store_true',
+                   help='summarize every run in the log together')
+    args = p.parse_args()
+
+    log = read_log(args.log)
+    if not args.all:
+        run = args.run if args.run is not None else log.run.iloc[-1]
+        log = log[log.run == run]
+        if log.empty:
+            print("No records for run {!r}.".format(run), file=sys.stderr)
+            sys.exit(1)
+        print("Run {}".format(run or '(unnamed)'), file=sys.stderr)
+
+    out, order = summarize(log)
+    out.to_csv(sys.stdout, sep='\t', index=False)
+    for target, seconds in order.items():
+        print("{:6.1%}  {:10.2f}s  {}".format(seconds / order.sum(), seconds,
+                                             target), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Tally per-library read totals and per-taxon incidence in one pass.
+
+Reads _rrs_library_taxon_count once and (re)writes three small tables that
+back the corresponding views in schema_results.sql:
+
+    _rrs_library_endemic_total    reads NOT from a spike, per library/level
+    _rrs_library_spike_total      reads from each spike, per library/level
+    _rrs_library_taxon_incidence  libraries with reads from each taxon
+
+Reads are assigned to spikes through the rrs_library_spike_taxon view.
+import_db.py runs this after loading a database with these tables, and after
+any incremental re-import of the tables in SOURCES.
+
+usage:
+
+    tally_rrs_totals.py DB
+
+"""
+
+import collections
+import sqlite3
+import sys
+from lib import instrument
+
+TABLES = [ ('_rrs_library_endemic_total',
+             ['rrs_library_id', 'taxon_level', 'total'])
+         , ('_rrs_library_spike_total',
+             ['rrs_library_id', 'taxon_level', 'spike_seq_id', 'total'])
+         , ('_rrs_library_taxon_incidence',
+             ['taxon_level', 'taxon_id', 'incidence'])
+         ]
+# The tables read by the tally, directly or through rrs_library_spike_taxon.
+SOURCES = { '_rrs_library_taxon_count', 'rrs_spike_strain_hit', 'rrs_library'
+          , 'extraction', 'spike'
+          }
+
+
+def add(totals, key, tally):
+    # Like SUM(), NULL tallies are skipped but still make a (NULL) group.
+    if tally is None:
+        totals.setdefault(key, None)
+    else:
+        totals[key] = (totals.get(key) or 0) + tally
+
+
+def tally(con):
+    """Return (endemic totals, spike totals, incidence) dicts."""
+    spikes = collections.defaultdict(list)
+    for library, level, taxon, spike in con.execute(
+            'SELECT rrs_library_id, taxon_level, taxon_id, spike_seq_id '
+            'FROM rrs_library_spike_taxon'):
+        spikes[(library, level, taxon)].append(spike)
+
+    endemic, spike_total = {}, {}
+    incidence = collections.Counter()
+    for library, level, taxon, count in con.execute(
+            'SELECT rrs_library_id, taxon_level, taxon_id, tally '
+            'FROM _rrs_library_taxon_count'):
+        hits = spikes.get((library, level, taxon))
+        if hits:
+            for spike in hits:
+                add(spike_total, (library, level, spike), count)
+        else:
+            add(endemic, (library, level), count)
+        if count is not None and count > 0:
+            incidence[(level, taxon)] += 1
+    return endemic, spike_total, incidence
+
+
+def has_tables(con):
+    """Whether the database has the tables to tally into."""
+    names = {name for name, in con.execute("SELECT name FROM sqlite_master "
+                                           "WHERE type = 'table'")}
+    return all(table in names for table, _ in TABLES)
+
+
+def refresh(con):
+    """Rewrite all three tables, inside the caller's transaction."""
+    with instrument.stage('tally'):
+        results = tally(con)
+    for (table, columns), values in zip(TABLES, results):
+        with instrument.stage('write:' + table, rows=len(values)):
+            con.execute('DELETE FROM {}'.format(table))
+            con.executemany('INSERT INTO {} ({}) VALUES ({})'
+                            .format(table, ', '.join(columns),
+                                    ', '.join('?' for _ in columns)),
+                            (key + (value,) for key, value in values.items()))
+        print("Wrote {} rows into {}.".format(len(values), table),
+              file=sys.stderr)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    con = sqlite3.connect(sys.argv[1], isolation_level=None)
+    con.execute('BEGIN')
+    refresh(con)
+    con.execute('COMMIT')
+    con.execute('ANALYZE')
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Tests for scripts/lib/stats.py; run with `python -m pytest tests`."""
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats
+from scipy import sparse
+from scripts.lib import matrix, stats
+
+
+@pytest.fixture
+def mice():
+    rs = np.random.RandomState(0)
+    n = 60
+    index = pd.Index(['m{}'.format(i) for i in range(n)], name='mouse_id')
+    data = pd.DataFrame({'treatment': rs.choice(['control', 'acarbose'], n),
+                         'sex': rs.choice(['male', 'female'], n),
+                         'site': rs.choice(['UM', 'UT'], n)},
+                        index=index)
+    data['age_at_collect'] = rs.uniform(100, 300, n)
+    data['age_at_death_or_censor'] = (data.age_at_collect
+                                      + rs.exponential(400, n))
+    data['dead'] = rs.random_sample(n) < 0.7
+    features = pd.DataFrame(rs.poisson(1, (n, 5))
+                            * (rs.random_sample((n, 5)) < 0.5),
+                            index=index,
+                            columns=['f{}'.format(i) for i in range(5)])
+    return data, features.astype(float)
+
+
+def test_mannwhitneyu_screen_matches_scipy(mice):
+    data, features = mice
+    out = stats.mannwhitneyu_screen(features, data, 'treatment')
+    first, second = data.treatment.unique()
+    for name in features:
+        expect = scipy.stats.mannwhitneyu(
+                features[name][data.treatment == first],
+                features[name][data.treatment == second],
+                alternative='two-sided', method='asymptotic')
+        assert np.isclose(out.U[name], expect.statistic)
+        assert np.isclose(out.pvalue[name], expect.pvalue)
+
+
+def test_mannwhitneyu_screen_sparse(mice):
+    data, features = mice
+    labeled = matrix.LabeledMatrix(sparse.csr_matrix(features.values),
+                                   features.index, features.columns)
+    dense = stats.mannwhitneyu_screen(features, data, 'treatment')
+    out = stats.mannwhitneyu_screen(labeled, data, 'treatment')
+    assert np.allclose(out.values, dense.values, equal_nan=True)
+
+
+@pytest.mark.parametrize('screen', [
+    lambda features, data: stats.mannwhitneyu_screen(features, data,
+                                                     'treatment'),
+    lambda features, data: stats.phreg_screen(features, data),
+    ])
+def test_screens_leave_out_rows_missing_from_features(mice, screen):
+    data, features = mice
+    subset = features.iloc[3:]
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        out = screen(subset, data)
+    assert any("3 of 60 rows" in str(w.message) for w in caught)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expect = screen(subset, data.iloc[3:])
+    assert np.allclose(out.values, expect.values, equal_nan=True)